@@ -104,7 +104,6 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -113,6 +112,14 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'wuliu.processor.pros'
             ],
+            # 显式启用缓存模板加载器(无论DEBUG与否), 大量通过inclusion_tag渲染的小模板只需解析一次
+            # 指定loaders时不能同时设置APP_DIRS, app_directories.Loader起到同样的作用
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
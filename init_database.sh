@@ -47,9 +47,9 @@ index 92406c3..8c5aa12 100644
  
 -from . import views, apis
  
- # Unused
  def easy_path(view_func):
-@@ -8,6 +7,8 @@ def easy_path(view_func):
+     """ 只需给定视图函数, route和name都设置为视图函数的名字 """
+@@ -7,6 +6,8 @@ def easy_path(view_func):
      return path(view_func.__name__, view_func, name=view_func.__name__)
  
  app_name = "wuliu"
@@ -57,8 +57,8 @@ index 92406c3..8c5aa12 100644
 +'''
  urlpatterns = [
      # 登录
-     path("login", views.login, name="login"),
-@@ -136,3 +137,4 @@ urlpatterns = [
+     easy_path(views.login),
+@@ -135,3 +136,4 @@ urlpatterns = [
          ])),
      ])),
  ]
@@ -16,6 +16,7 @@ class ExpireLruCache:
     和标准库中的functools.lru_cache一样, 被装饰的函数不能使用不可哈希的参数
     参数expire_time为过期时间, 必须是datetime.timedelta类型, 默认为3分钟
     参数enable_log为真值时, 则每次取出缓存时记录日志[方法名, 参数, 获取缓存的次数]
+    被装饰的函数会附带一个cache_clear方法, 用于在数据变更时主动清除该函数的全部缓存
     """
 
     def __init__(self, expire_time=timezone.timedelta(minutes=3), enable_log=False):
@@ -35,6 +36,9 @@ class ExpireLruCache:
         ))
 
     def __call__(self, func):
+        # 记录属于被装饰函数的缓存键, 以便cache_clear只清除该函数的缓存
+        func_keys = set()
+
         @wraps(func)
         def _func(*args, **kwargs):
             # 被装饰函数调用时的每个参数都必须是可哈希的
@@ -57,7 +61,16 @@ class ExpireLruCache:
                     "latest_update_time": timezone.now(),
                     "count": 0,
                 }
+                func_keys.add(key_)
             return result
+
+        def cache_clear():
+            with self._lock:
+                for key_ in func_keys:
+                    self._dic.pop(key_, None)
+                func_keys.clear()
+
+        _func.cache_clear = cache_clear
         return _func
 
 '''
@@ -77,6 +90,9 @@ def ExpireLruCache(expire_time=timezone.timedelta(minutes=3), enable_log=False):
         ))
 
     def wrapper(func):
+        # 记录属于被装饰函数的缓存键, 以便cache_clear只清除该函数的缓存
+        func_keys = set()
+
         @wraps(func)
         def _func(*args, **kwargs):
             nonlocal _dic
@@ -98,7 +114,16 @@ def ExpireLruCache(expire_time=timezone.timedelta(minutes=3), enable_log=False):
                     "latest_update_time": timezone.now(),
                     "count": 0,
                 }
+                func_keys.add(key_)
             return result
+
+        def cache_clear():
+            with _lock:
+                for key_ in func_keys:
+                    _dic.pop(key_, None)
+                func_keys.clear()
+
+        _func.cache_clear = cache_clear
         return _func
 
     return wrapper
@@ -4,7 +4,6 @@ from django.contrib import messages
 from django.contrib.auth.hashers import check_password
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.models import Q
 from django.http import HttpResponseBadRequest
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -530,14 +529,14 @@ class StartTransportOut(ActionApi):
         to_obj.waybills.update(status=waybills_status+1)
         WaybillRouting.objects.bulk_create([
             WaybillRouting(
-                waybill=wb,
+                waybill_id=wb_id,
                 time=timezone_now,
                 operation_type=waybills_status+1,
                 operation_dept=logged_user_department,
                 operation_user=logged_user,
                 operation_info={"transport_out_id": to_obj.id}
             )
-            for wb in to_obj.waybills.all()
+            for wb_id in to_obj.waybills.values_list("id", flat=True)
         ])
         to_obj.save()
 
@@ -593,13 +592,13 @@ class ConfirmArrival(ActionApi):
             to_obj.waybills.all().update(arrival_time=timezone_now)
         WaybillRouting.objects.bulk_create([
             WaybillRouting(
-                waybill=wb,
+                waybill_id=wb_id,
                 time=timezone_now,
                 operation_type=waybills_status_now,
                 operation_dept=logged_user_department,
                 operation_user=logged_user,
             )
-            for wb in to_obj.waybills.all()
+            for wb_id in to_obj.waybills.values_list("id", flat=True)
         ])
         to_obj.save()
 
@@ -621,12 +620,18 @@ class ConfirmSignFor(ActionApi):
             sign_for_waybill_ids = validate_comma_separated_integer_list_and_split(sign_for_waybill_ids)
         except ValidationError as exc:
             raise ActionApi.AbortException("请求格式无效！") from exc
-        if Waybill.objects.filter(id__in=sign_for_waybill_ids).count() != len(sign_for_waybill_ids):
+        # 请求中的运单数量有限, 一次性查出到达部门和状态后在内存中检查
+        waybill_infos = list(
+            Waybill.objects.filter(id__in=sign_for_waybill_ids).values_list("dst_department_id", "status")
+        )
+        if len(waybill_infos) != len(sign_for_waybill_ids):
             raise ActionApi.AbortException("请求中存在不存在的运单！")
         # 禁止签收到达部门与当前部门不一致的运单, 以及非"到站待提"状态的运单
-        if Waybill.objects.filter(id__in=sign_for_waybill_ids).filter(
-                ~Q(dst_department__id=self.request.session["user"]["department_id"]) |
-                ~Q(status=Waybill.Statuses.Arrived)).exists():
+        dept_id = self.request.session["user"]["department_id"]
+        if any(
+            dst_dept_id != dept_id or status != Waybill.Statuses.Arrived
+            for dst_dept_id, status in waybill_infos
+        ):
             raise ActionApi.AbortException("请求中存在状态异常的运单！")
         timezone_now = timezone.now()
         self._private_dic = {
@@ -651,13 +656,13 @@ class ConfirmSignFor(ActionApi):
         )
         WaybillRouting.objects.bulk_create([
             WaybillRouting(
-                waybill=wb,
+                waybill_id=wb_id,
                 time=timezone_now,
                 operation_type=Waybill.Statuses.SignedFor,
                 operation_dept=logged_user_department,
                 operation_user=logged_user,
             )
-            for wb in Waybill.objects.filter(id__in=sign_for_waybill_ids)
+            for wb_id in Waybill.objects.filter(id__in=sign_for_waybill_ids).values_list("id", flat=True)
         ])
 
     def actions_after_success(self):
@@ -6,23 +6,25 @@ from django.utils import timezone
 
 from .models import (
     User, Waybill, TransportOut, DepartmentPayment, CargoPricePayment, Permission, PermissionGroup,
-    _get_global_settings,
+    get_global_settings,
 )
 from utils.common import ExpireLruCache, model_to_dict_
 
 
 _EXPIRE_LRU_CACHE_1MIN = ExpireLruCache(expire_time=timezone.timedelta(minutes=1))
 
-get_global_settings = ExpireLruCache(expire_time=timezone.timedelta(hours=3))(_get_global_settings)
-
 @_EXPIRE_LRU_CACHE_1MIN
 def _get_logged_user_by_id(user_id: int) -> User:
     """ 根据用户id返回用户模型对象 """
-    return User.objects.get(id=user_id)
+    # 判断用户类型(User.get_type)时会访问所属部门及其父部门, 一并查出
+    return User.objects.select_related("department__father_department").get(id=user_id)
 
 def get_logged_user(request) -> User:
-    """ 获取已登录的用户对象 """
-    return _get_logged_user_by_id(request.session["user"]["id"])
+    """ 获取已登录的用户对象, 结果保存在request对象上, 同一个请求内多次调用时直接返回 """
+    user = getattr(request, "_logged_user", None)
+    if user is None:
+        user = request._logged_user = _get_logged_user_by_id(request.session["user"]["id"])
+    return user
 
 def get_logged_user_type(request) -> User.Types:
     """ 获取已登录的用户的用户类型 """
@@ -39,7 +41,11 @@ def is_logged_user_has_perm(request, perm_name: str) -> bool:
     """
     if not perm_name:
         return True
-    return perm_name in _get_user_permissions(get_logged_user(request))
+    # 同一个请求内(例如渲染侧边栏时)会多次检查权限, 将权限集合保存在request对象上
+    user_permissions = getattr(request, "_logged_user_permissions", None)
+    if user_permissions is None:
+        user_permissions = request._logged_user_permissions = _get_user_permissions(get_logged_user(request))
+    return perm_name in user_permissions
 
 def is_logged_user_is_goods_yard(request) -> bool:
     """ 判断已登录的用户是否属于货场 """
@@ -1,10 +1,11 @@
 import datetime as datetime_
 import math
+from functools import partial
 
 from django import forms
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Q, F, QuerySet
+from django.db.models import Q, F, Count, Sum, QuerySet, Exists, OuterRef, Value
 
 from .models import (
     User, Waybill, WaybillRouting, Department, Customer, TransportOut, Truck,
@@ -15,12 +16,32 @@ from utils.common import SortableModelChoiceField
 
 
 DATA_MIN = datetime_.date(1970, 1, 1)
+_BRANCH_GROUP_DEPTS = tuple(Department.objects.filter(is_branch_group=True).values_list("id", "name"))
 DEPARTMENT_GROUP_CHOICES = {
     0: "全部",
-    **{index: dept.name for index, dept in enumerate(Department.objects.filter(is_branch_group=True), 1)}
+    **{index: dept_name for index, (_, dept_name) in enumerate(_BRANCH_GROUP_DEPTS, 1)}
 }
+DEPARTMENT_GROUP_CHOICES_TUPLE = tuple(DEPARTMENT_GROUP_CHOICES.items())
+# 分支机构分组选项值 -> 分支机构分组的部门id, 按id筛选可以省去一次对部门表的连接查询
+_DEPARTMENT_GROUP_ID_DIC = {index: dept_id for index, (dept_id, _) in enumerate(_BRANCH_GROUP_DEPTS, 1)}
+_DEPARTMENT_GROUP_ALL_CHOICES = ((0, "全部"), )
 
 
+def _date_str_days_ago(days: int) -> str:
+    """ 返回days天前的日期字符串 (格式: YYYY-mm-dd) """
+    return timezone.make_naive(timezone.now() - timezone.timedelta(days=days)).strftime("%Y-%m-%d")
+
+def _default_date_range(days: int) -> tuple:
+    """ 返回(days天前, 今天)的日期字符串, 两者基于同一个当前时间计算 """
+    now = timezone.make_naive(timezone.now())
+    return (now - timezone.timedelta(days=days)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+
+def _own_department_choices(user: User) -> tuple:
+    """ 生成只包含用户所属部门这一个选项的choices
+    部门名称通过带缓存的Department.get_name_by_id获取, 避免每次初始化表单时都查询一次部门表
+    """
+    return ((user.department_id, Department.get_name_by_id(user.department_id)), )
+
 def _init_form_fields_class(self_: forms.BaseForm):
     """ 为所有表单项配置样式 """
     for field in self_.fields.values():
@@ -45,6 +66,19 @@ def _destroy_model_form_save(self_: forms.ModelForm):
         raise NotImplemented
     self_.save = save_
 
+def _filter_by_date_range(queryset: QuerySet, field_name: str, date_start, date_end) -> QuerySet:
+    """ 按日期区间对queryset的某个DateTimeField字段进行筛选
+    未指定开始日期时则从DATA_MIN开始, 未指定结束日期时则截止到今天
+    """
+    return queryset.filter(**{
+        "%s__gte" % field_name: timezone.make_aware(
+            timezone.datetime.combine(date_start or DATA_MIN, datetime_.time())
+        ),
+        "%s__lte" % field_name: timezone.make_aware(
+            timezone.datetime.combine(date_end or datetime_.date.today(), datetime_.time(23, 59, 59))
+        ),
+    })
+
 class _FormBase(forms.Form):
 
     def __init__(self, *args, **kwargs):
@@ -132,7 +166,7 @@ class WaybillForm(_ModelFormBase):
         )
         # 如果有可选的发货部门, 则不允许发货部门选择空值 (默认有且只有一个可选项, 就是用户所属的部门)
         # 如果没有任何可选的发货部门, 则允许发货部门选择空值, 否则前端提交的form中将缺少src_department字段, 引发一系列异常
-        if list(form_obj.fields["src_department"].queryset):
+        if form_obj.fields["src_department"].queryset.exists():
             form_obj.fields["src_department"].empty_label = None
         return form_obj
 
@@ -231,12 +265,12 @@ class WaybillForm(_ModelFormBase):
 class WaybillSearchForm(_FormBase):
     create_date_start = forms.DateField(
         label="开票日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=7)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 7),
     )
     create_time_start = forms.TimeField(label="-", required=False, initial="00:00")
     create_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now()).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 0),
     )
     create_time_end = forms.TimeField(label="-", required=False, initial="23:59")
 
@@ -249,10 +283,10 @@ class WaybillSearchForm(_FormBase):
     dst_department = forms.ModelChoiceField(Department.queryset_is_branch(), required=False, label="到达部门")
 
     src_department_group = forms.ChoiceField(
-        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES.items(), initial=0,
+        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES_TUPLE, initial=0,
     )
     dst_department_group = forms.ChoiceField(
-        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES.items(), initial=0,
+        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES_TUPLE, initial=0,
     )
 
     src_customer_name = forms.CharField(label="发货人", required=False)
@@ -285,8 +319,8 @@ class WaybillSearchForm(_FormBase):
         user_type = user.get_type
         # 分支机构用户只能管理自己部门的运单
         if user_type == User.Types.Branch:
-            form_obj.fields["src_department"].choices = [(user.department_id, user.department.name), ]
-            form_obj.fields["src_department_group"].choices = [(0, "全部"), ]
+            form_obj.fields["src_department"].choices = _own_department_choices(user)
+            form_obj.fields["src_department_group"].choices = _DEPARTMENT_GROUP_ALL_CHOICES
         # 货场用户不限制开票日期的时间范围
         elif user_type == User.Types.GoodsYard:
             form_obj.fields["create_date_start"].initial = None
@@ -370,17 +404,13 @@ class WaybillSearchForm(_FormBase):
             r_queryset = r_queryset.filter(src_department=form_dic["src_department"])
         elif form_dic["src_department_group"]:
             r_queryset = r_queryset.filter(
-                src_department__father_department__name=(
-                    DEPARTMENT_GROUP_CHOICES.get(form_dic["src_department_group"])
-                )
+                src_department__father_department_id=_DEPARTMENT_GROUP_ID_DIC.get(form_dic["src_department_group"])
             )
         if form_dic["dst_department"]:
             r_queryset = r_queryset.filter(dst_department=form_dic["dst_department"])
         elif form_dic["dst_department_group"]:
             r_queryset = r_queryset.filter(
-                dst_department__father_department__name=(
-                    DEPARTMENT_GROUP_CHOICES.get(form_dic["dst_department_group"])
-                )
+                dst_department__father_department_id=_DEPARTMENT_GROUP_ID_DIC.get(form_dic["dst_department_group"])
             )
         # 按发货/收货人姓名/电话查询 (电话优先级高于姓名)
         if form_dic["src_customer_phone"]:
@@ -414,7 +444,7 @@ class WaybillQuickSearchForm(forms.Form):
             if r_queryset.exists():
                 return r_queryset
         # 假设用户输入的是发货人/收货人的姓名/电话号
-        return Waybill.objects.filter(
+        return Waybill.objects.select_related("src_department", "dst_department").filter(
             Q(src_customer_name=search_str) | Q(dst_customer_name=search_str) |
             Q(src_customer_phone=search_str) | Q(dst_customer_phone=search_str)
         )
@@ -437,10 +467,7 @@ class SignForSearchForm(WaybillSearchForm):
         ]
         self.fields["waybill_status"].initial = [Waybill.Statuses.Arrived, ]
         # 初始化到货日期字段
-        self.fields["arrival_date_start"].initial = timezone.make_naive(
-                timezone.now() - timezone.timedelta(days=7)
-            ).strftime("%Y-%m-%d")
-        self.fields["arrival_date_end"].initial = timezone.make_naive(timezone.now()).strftime("%Y-%m-%d")
+        self.fields["arrival_date_start"].initial, self.fields["arrival_date_end"].initial = _default_date_range(7)
 
     @classmethod
     def init_from_request(cls, request, *args, **kwargs):
@@ -448,8 +475,8 @@ class SignForSearchForm(WaybillSearchForm):
         user = get_logged_user(request)
         # 开票部门不限制, 对于分支机构和货场, 到达部门只能选择自己部门
         if user.get_type in (User.Types.Branch, User.Types.GoodsYard):
-            form_obj.fields["dst_department"].choices = [(user.department_id, user.department.name), ]
-            form_obj.fields["dst_department_group"].choices = [(0, "全部"), ]
+            form_obj.fields["dst_department"].choices = _own_department_choices(user)
+            form_obj.fields["dst_department_group"].choices = _DEPARTMENT_GROUP_ALL_CHOICES
         return form_obj
 
     def gen_waybill_list_to_queryset(self) -> QuerySet:
@@ -530,32 +557,42 @@ class TransportOutForm(_ModelFormBase):
         assert (
             form_dic["dst_department"].is_branch if logged_user_is_goods_yard else True
         ), "货场只能发车到分支机构"
+        # 一次性查出提交的运单的状态, 开票部门, 以及是否已配载在本车次中, 之后的检查均在内存中进行
+        waybills = form_dic["waybills"]
+        if transport_out_id:
+            waybills = waybills.annotate(in_this_transport_out=Exists(
+                TransportOut.waybills.through.objects.filter(
+                    transportout_id=transport_out_id, waybill_id=OuterRef("pk")
+                )
+            ))
+        else:
+            waybills = waybills.annotate(in_this_transport_out=Value(False))
+        waybills_info = list(waybills.values_list("status", "src_department_id", "in_this_transport_out"))
+        loaded_statuses = (Waybill.Statuses.Loaded, Waybill.Statuses.GoodsYardLoaded)
         # 对于货场, 只允许有"货场入库"或"货场配载"的运单
-        if is_logged_user_is_goods_yard(request):
-            assert not form_dic["waybills"].exclude(
-                status__in=[Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.GoodsYardLoaded]
-            ).exists(), '只允许有"货场入库"或"货场配载"的运单'
+        if logged_user_is_goods_yard:
+            assert all(
+                status in (Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.GoodsYardLoaded)
+                for status, _, _ in waybills_info
+            ), '只允许有"货场入库"或"货场配载"的运单'
         # 否则, 只允许有"已开票 已配载"的运单, 并检查发车部门和开票部门是否一致
         else:
-            assert not form_dic["waybills"].filter(
-                status__gt=Waybill.Statuses.Loaded
-            ).exists(), '只允许有"已开票"或"已配载"的运单'
-            assert (
-                not form_dic["waybills"].exclude(src_department__id=request.session["user"]["department_id"]).exists()
+            assert all(
+                status <= Waybill.Statuses.Loaded for status, _, _ in waybills_info
+            ), '只允许有"已开票"或"已配载"的运单'
+            assert all(
+                src_dept_id == request.session["user"]["department_id"] for _, src_dept_id, _ in waybills_info
             ), "存在发车部门和开票部门不一致的运单"
         # 对于已创建并保存的车次, 检查"已配载/货场配载"的运单所配载的车次id与本车次id是否一致
         if transport_out_id:
-            assert (
-                not form_dic["waybills"].filter(
-                    status__in=[Waybill.Statuses.Loaded, Waybill.Statuses.GoodsYardLoaded]
-                ).exclude(transportout_id=transport_out_id).exists()
+            assert all(
+                in_this_transport_out or status not in loaded_statuses
+                for status, _, in_this_transport_out in waybills_info
             ), "该车次中存在所属车次不一致的配载状态运单"
         # 对于尚未创建和保存的车次, 禁止存在"已配载/货场配载"的运单
         else:
-            assert (
-                not form_dic["waybills"].filter(
-                    status__in=[Waybill.Statuses.Loaded, Waybill.Statuses.GoodsYardLoaded]
-                ).exists()
+            assert not any(
+                status in loaded_statuses for status, _, _ in waybills_info
             ), "新建车次中不允许存在配载状态运单"
 
     def change_to_detail_form(self):
@@ -621,19 +658,19 @@ class TransportOutSearchForm(_FormBase):
     )
     create_date_start = forms.DateField(
         label="创建日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=7)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 7),
     )
     create_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now()).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 0),
     )
     start_date_start = forms.DateField(
         label="发车日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=7)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 7),
     )
     start_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now()).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 0),
     )
     src_department = forms.ModelChoiceField(
         Department.queryset_is_branch() | Department.queryset_is_goods_yard(),
@@ -656,14 +693,10 @@ class TransportOutSearchForm(_FormBase):
         if user.get_type in (User.Types.Branch, User.Types.GoodsYard):
             # 分支机构和货场用户只能管理自己部门的发车车次
             if form_obj._search_mode == "src":
-                form_obj.fields["src_department"].choices = [
-                    (user.department_id, user.department.name),
-                ]
+                form_obj.fields["src_department"].choices = _own_department_choices(user)
             # 分支机构和货场用户只能管理到达自己部门的车次
             elif form_obj._search_mode == "dst":
-                form_obj.fields["dst_department"].choices = [
-                    (user.department_id, user.department.name),
-                ]
+                form_obj.fields["dst_department"].choices = _own_department_choices(user)
         if form_obj._search_mode == "dst":
             form_obj.fields["status"].initial = [TransportOut.Statuses.OnTheWay, ]
         return form_obj
@@ -695,7 +728,7 @@ class TransportOutSearchForm(_FormBase):
         return queryset.filter(q_obj)
 
     def gen_transport_out_list_to_queryset(self) -> QuerySet:
-        """ 根据表单内容执行查询操作, 返回一个QuerySet对象 """
+        """ 根据表单内容执行查询操作, 返回车次查询集(已附加配载运单的统计信息) """
         form_dic = self.cleaned_data
         r_queryset = TransportOut.objects.all().select_related("truck", "src_department", "dst_department")
         # 指定车次编号的话, 直接返回对应的一个车次
@@ -728,11 +761,13 @@ class TransportOutSearchForm(_FormBase):
         # 按车次状态查询
         if form_dic["status"] and self.need_filter("status", form_dic["status"]):
             r_queryset = r_queryset.filter(status__in=form_dic["status"])
-        for transport_out_obj in r_queryset:
-            transport_out_waybills_info = transport_out_obj.gen_waybills_info()
-            for k, v in transport_out_waybills_info.items():
-                setattr(transport_out_obj, k, v)
-        return r_queryset
+        # 配载运单的统计信息(同TransportOut.gen_waybills_info)直接在数据库中分组聚合
+        return r_queryset.annotate(
+            total_num=Count("waybills"),
+            total_cargo_num=Sum("waybills__cargo_num"),
+            total_cargo_volume=Sum("waybills__cargo_volume"),
+            total_cargo_weight=Sum("waybills__cargo_weight"),
+        ).order_by("id")
 
 class DepartmentPaymentDetailForm(_ModelFormBase):
 
@@ -786,12 +821,12 @@ class DepartmentPaymentAddForm(_FormBase):
         Department.queryset_is_branch(), required=False, label="回款部门",
     )
     src_department_group = forms.ChoiceField(
-        label="-", choices=tuple(DEPARTMENT_GROUP_CHOICES.items()), initial=0,
+        label="-", choices=DEPARTMENT_GROUP_CHOICES_TUPLE, initial=0,
     )
     dst_department = forms.ModelChoiceField(Department.objects.all(), label="收款部门")
     payment_date = forms.DateField(
         label="应回款日期",
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=1)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 1),
     )
     dst_remark = forms.CharField(
         label="收款部门备注", required=False,
@@ -822,18 +857,20 @@ class DepartmentPaymentAddForm(_FormBase):
         if form_dic["src_department"]:
             src_depts = form_dic["src_department"]
         else:
-            if form_dic["src_department_group"] != 0:
+            src_department_group = int(form_dic["src_department_group"])
+            if src_department_group != 0:
                 src_depts = Department.objects.filter(
-                    father_department__name=DEPARTMENT_GROUP_CHOICES[form_dic["src_department_group"]]
+                    father_department_id=_DEPARTMENT_GROUP_ID_DIC[src_department_group]
                 )
             else:
                 src_depts = Department.objects.all()
-        existed_dp = DepartmentPayment.objects.filter(
+        # 一次查询同时完成存在性检查和冲突部门名称的获取 (最多取50个, 避免错误信息过长)
+        existed_dept_names = list(DepartmentPayment.objects.filter(
             src_department__in=src_depts, payment_date=form_dic["payment_date"]
-        )
-        if existed_dp.exists():
+        ).values_list("src_department__name", flat=True)[:50])
+        if existed_dept_names:
             raise Exception("部门 %s，在%s已有回款单，不允许再次添加！" % (
-                "、".join(['"%s"' % dp_obj.src_department.name for dp_obj in existed_dp]),
+                "、".join(['"%s"' % dept_name for dept_name in existed_dept_names]),
                 form_dic["payment_date"],
             ))
         with transaction.atomic():
@@ -851,15 +888,15 @@ class DepartmentPaymentAddForm(_FormBase):
 class DepartmentPaymentSearchForm(_FormBase):
     src_department = forms.ModelChoiceField(Department.queryset_is_branch(), required=False, label="回款部门")
     src_department_group = forms.ChoiceField(
-        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES.items(), initial=0,
+        label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES_TUPLE, initial=0,
     )
     payment_date_start = forms.DateField(
         label="应回款日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=1)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 1),
     )
     payment_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=1)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 1),
     )
     status = forms.MultipleChoiceField(
         label="状态", required=False,
@@ -873,8 +910,8 @@ class DepartmentPaymentSearchForm(_FormBase):
         user = get_logged_user(request)
         # 分支机构用户只能管理自己部门的转账单
         if user.get_type == User.Types.Branch:
-            form_obj.fields["src_department"].choices = [(user.department_id, user.department.name), ]
-            form_obj.fields["src_department_group"].choices = [(0, "全部"), ]
+            form_obj.fields["src_department"].choices = _own_department_choices(user)
+            form_obj.fields["src_department_group"].choices = _DEPARTMENT_GROUP_ALL_CHOICES
             form_obj.fields["status"].initial = [
                 DepartmentPayment.Statuses.Created, DepartmentPayment.Statuses.Reviewed,
             ]
@@ -898,9 +935,7 @@ class DepartmentPaymentSearchForm(_FormBase):
             r_queryset = r_queryset.filter(src_department=form_dic["src_department"])
         elif form_dic["src_department_group"]:
             r_queryset = r_queryset.filter(
-                src_department__father_department__name=(
-                    DEPARTMENT_GROUP_CHOICES.get(form_dic["src_department_group"])
-                )
+                src_department__father_department_id=_DEPARTMENT_GROUP_ID_DIC.get(form_dic["src_department_group"])
             )
         # 按状态查询
         if form_dic["status"] and self.need_filter("status", form_dic["status"]):
@@ -980,11 +1015,11 @@ class CargoPricePaymentSearchForm(_FormBase):
     )
     create_date_start = forms.DateField(
         label="创建日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=7)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 7),
     )
     create_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now()).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 0),
     )
     settle_accounts_date_start = forms.DateField(label="支付日期", required=False)
     settle_accounts_date_end = forms.DateField(label="至", required=False)
@@ -1004,26 +1039,13 @@ class CargoPricePaymentSearchForm(_FormBase):
         r_queryset = CargoPricePayment.objects.all().select_related("create_user")
         # 按创建日期/结算日期区间查询, 如果开始日期和结束日期都没有指定, 则不用筛选
         if form_dic["create_date_start"] or form_dic["create_date_end"]:
-            create_date_start = form_dic["create_date_start"] or DATA_MIN
-            create_date_end = form_dic["create_date_end"] or datetime_.date.today()
-            r_queryset = r_queryset.filter(
-                create_time__gte=timezone.make_aware(
-                    timezone.datetime.combine(create_date_start, datetime_.time())
-                ),
-                create_time__lte=timezone.make_aware(
-                    timezone.datetime.combine(create_date_end, datetime_.time(23, 59, 59))
-                ),
+            r_queryset = _filter_by_date_range(
+                r_queryset, "create_time", form_dic["create_date_start"], form_dic["create_date_end"]
             )
         elif form_dic["settle_accounts_date_start"] or form_dic["settle_accounts_date_end"]:
-            settle_accounts_date_start = form_dic["settle_accounts_date_start"] or DATA_MIN
-            settle_accounts_date_end = form_dic["settle_accounts_date_end"] or datetime_.date.today()
-            r_queryset = r_queryset.filter(
-                settle_accounts_time__gte=timezone.make_aware(
-                    timezone.datetime.combine(settle_accounts_date_start, datetime_.time())
-                ),
-                settle_accounts_time__lte=timezone.make_aware(
-                    timezone.datetime.combine(settle_accounts_date_end, datetime_.time(23, 59, 59))
-                ),
+            r_queryset = _filter_by_date_range(
+                r_queryset, "settle_accounts_time",
+                form_dic["settle_accounts_date_start"], form_dic["settle_accounts_date_end"],
             )
         # 按创建人查询
         if form_dic["create_user"]:
@@ -1086,11 +1108,11 @@ class CustomerScoreLogSearchForm(_FormBase):
     customer_phone = forms.CharField(label="客户电话", required=False)
     create_date_start = forms.DateField(
         label="积分变更日期", required=False,
-        initial=timezone.make_naive(timezone.now() - timezone.timedelta(days=7)).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 7),
     )
     create_date_end = forms.DateField(
         label="至", required=False,
-        initial=timezone.make_naive(timezone.now()).strftime("%Y-%m-%d"),
+        initial=partial(_date_str_days_ago, 0),
     )
 
     def gen_log_list_to_queryset(self) -> QuerySet:
@@ -1107,8 +1129,25 @@ class CustomerScoreLogSearchForm(_FormBase):
             r_queryset = r_queryset.filter(customer__phone=form_dic["customer_phone"])
         elif form_dic["customer_name"]:
             r_queryset = r_queryset.filter(customer__name=form_dic["customer_name"])
-        # 返回结果倒序排列(新的在前面)
-        return r_queryset.order_by("-id")
+        # 返回结果按变动时间倒序排列(新的在前面), 以便利用create_time上的索引, 时间相同时再按id倒序
+        return r_queryset.order_by("-create_time", "-id")
+
+# 代收货款状态的各种组合与对应的查询条件
+# (未选择和全选的情况不需要进行筛选, 所以不在其中)
+_CARGO_PRICE_STATUS_Q_DIC = {
+    # 无代收
+    frozenset({"0"}): Q(cargo_price=0),
+    # 未支付(无代收款转账单, 或代收款转账单状态不为"已支付")
+    frozenset({"1"}): Q(cargo_price__gt=0) & ~Q(cargo_price_payment__status=CargoPricePayment.Statuses.Paid),
+    # 已支付(代收款转账单状态为"已支付")
+    frozenset({"2"}): Q(cargo_price__gt=0, cargo_price_payment__status=CargoPricePayment.Statuses.Paid),
+    # 无代收 + 未支付, 即除"已支付"以外的运单
+    frozenset({"0", "1"}): ~Q(cargo_price__gt=0, cargo_price_payment__status=CargoPricePayment.Statuses.Paid),
+    # 无代收 + 已支付
+    frozenset({"0", "2"}): Q(cargo_price=0) | Q(cargo_price_payment__status=CargoPricePayment.Statuses.Paid),
+    # 有代收
+    frozenset({"1", "2"}): ~Q(cargo_price=0),
+}
 
 class ReportTableSrcWaybill(WaybillSearchForm):
     cargo_price_status = forms.MultipleChoiceField(
@@ -1124,28 +1163,9 @@ class ReportTableSrcWaybill(WaybillSearchForm):
     def gen_waybill_list_to_queryset(self) -> QuerySet:
         r_queryset = super().gen_waybill_list_to_queryset()
         form_dic = self.cleaned_data
-        form_dic_cargo_price_status = set(form_dic["cargo_price_status"])
         if self.need_filter("cargo_price_status", form_dic["cargo_price_status"]):
-            if form_dic_cargo_price_status == {"0"}:
-                # 无代收
-                r_queryset = r_queryset.filter(cargo_price=0)
-            elif form_dic_cargo_price_status == {"1", "2"}:
-                # 有代收
-                r_queryset = r_queryset.exclude(cargo_price=0)
-            else:
-                q_obj = Q()
-                if "0" in form_dic_cargo_price_status:
-                    # 无代收
-                    q_obj |= Q(cargo_price=0)
-                if "1" in form_dic_cargo_price_status:
-                    # 未支付(无代收款转账单, 或代收款转账单状态不为"已支付")
-                    q_obj |= (
-                        Q(cargo_price__gt=0, cargo_price_payment__isnull=True) |
-                        (Q(cargo_price__gt=0) & ~Q(cargo_price_payment__status=CargoPricePayment.Statuses.Paid))
-                    )
-                if "2" in form_dic_cargo_price_status:
-                    # 已支付(代收款转账单状态为"已支付")
-                    q_obj |= Q(cargo_price__gt=0, cargo_price_payment__status=CargoPricePayment.Statuses.Paid)
+            q_obj = _CARGO_PRICE_STATUS_Q_DIC.get(frozenset(form_dic["cargo_price_status"]))
+            if q_obj is not None:
                 r_queryset = r_queryset.filter(q_obj)
         return r_queryset
 
@@ -1160,20 +1180,23 @@ class ReportTableStockWaybill(WaybillSearchForm):
     def gen_waybill_list_to_queryset(self):
         r_queryset = super().gen_waybill_list_to_queryset()
         r_queryset = r_queryset.only(
-            *"id create_time src_department dst_department fee status arrival_time".split()
+            *"id create_time src_department dst_department fee status arrival_time return_waybill".split()
         )
+        operation_time_keys = {
+            Waybill.Statuses.Departed: "departed_time",
+            Waybill.Statuses.GoodsYardArrived: "goods_yard_arrived_time",
+            Waybill.Statuses.GoodsYardDeparted: "goods_yard_departed_time",
+        }
+        # 一次查询取出所有运单的相关路由时间, 而不是对每个运单分别查询
+        routing_time_dic = {
+            (waybill_id, operation_type): time
+            for waybill_id, operation_type, time in WaybillRouting.objects.filter(
+                waybill__in=r_queryset, operation_type__in=operation_time_keys.keys(),
+            ).order_by("time").values_list("waybill_id", "operation_type", "time")
+        }
         for wb_obj in r_queryset:
-            waybill_routing = wb_obj.waybillrouting_set.all()
-            for key, operation_type in (
-                ("departed", Waybill.Statuses.Departed),
-                ("goods_yard_arrived", Waybill.Statuses.GoodsYardArrived),
-                ("goods_yard_departed", Waybill.Statuses.GoodsYardDeparted)
-            ):
-                key += "_time"
-                try:
-                    setattr(wb_obj, key, waybill_routing.get(operation_type=operation_type).time)
-                except WaybillRouting.DoesNotExist:
-                    setattr(wb_obj, key, None)
+            for operation_type, key in operation_time_keys.items():
+                setattr(wb_obj, key, routing_time_dic.get((wb_obj.id, operation_type)))
         return r_queryset
 
 class ReportTableDstWaybill(SignForSearchForm):
@@ -1194,10 +1217,7 @@ class ReportTableDstStockWaybill(WaybillSearchForm):
         self.fields["waybill_status"].widget.attrs["class"] = ""
         self.fields["waybill_status"].widget.attrs["hidden"] = True
         # 初始化到货日期字段
-        self.fields["arrival_date_start"].initial = timezone.make_naive(
-                timezone.now() - timezone.timedelta(days=7)
-            ).strftime("%Y-%m-%d")
-        self.fields["arrival_date_end"].initial = timezone.make_naive(timezone.now()).strftime("%Y-%m-%d")
+        self.fields["arrival_date_start"].initial, self.fields["arrival_date_end"].initial = _default_date_range(7)
 
     @classmethod
     def init_from_request(cls, request, *args, **kwargs):
@@ -1206,19 +1226,20 @@ class ReportTableDstStockWaybill(WaybillSearchForm):
         user_type = user.get_type
         # 分支机构用户只能管理自己部门的运单
         if user_type == User.Types.Branch:
-            form_obj.fields["dst_department"].choices = [(user.department_id, user.department.name), ]
-            form_obj.fields["dst_department_group"].choices = [(0, "全部"), ]
+            form_obj.fields["dst_department"].choices = _own_department_choices(user)
+            form_obj.fields["dst_department_group"].choices = _DEPARTMENT_GROUP_ALL_CHOICES
         return form_obj
 
-    def gen_waybill_list_to_queryset(self) -> QuerySet:
+    def gen_waybill_list_to_queryset(self) -> list:
         r_queryset = super().gen_waybill_list_to_queryset()
         form_dic = self.cleaned_data
         if form_dic["arrival_date_start"] or form_dic["arrival_date_end"]:
             r_queryset = self.filter_by_arrival_time(form_dic, r_queryset)
         timezone_now = timezone.now()
-        for wb_obj in r_queryset:
+        waybill_list = list(r_queryset)
+        for wb_obj in waybill_list:
             wb_obj.stay_days = (timezone_now - wb_obj.arrival_time).days
-        return r_queryset
+        return waybill_list
 
 class ReportTableSignForWaybill(SignForSearchForm):
 
@@ -1229,10 +1250,7 @@ class ReportTableSignForWaybill(SignForSearchForm):
         self.fields["waybill_status"].widget.attrs["class"] = ""
         self.fields["waybill_status"].widget.attrs["hidden"] = True
         # 初始化到货日期字段
-        self.fields["sign_for_date_start"].initial = timezone.make_naive(
-                timezone.now() - timezone.timedelta(days=7)
-            ).strftime("%Y-%m-%d")
-        self.fields["sign_for_date_end"].initial = timezone.make_naive(timezone.now()).strftime("%Y-%m-%d")
+        self.fields["sign_for_date_start"].initial, self.fields["sign_for_date_end"].initial = _default_date_range(7)
 
 class ManageUsers(_FormBase):
     user = forms.ModelChoiceField(
@@ -1244,7 +1262,7 @@ class ManageUsers(_FormBase):
     administrator = forms.BooleanField(label="管理员", required=False, initial=False)
     department = forms.ChoiceField(
         label="所属部门",
-        choices=sorted(((dept.id, dept.tree_str) for dept in Department.objects.all()), key=lambda x: x[1]),
+        choices=sorted(Department.gen_tree_str_dic().items(), key=lambda x: x[1]),
     )
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-16 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wuliu', '0001_squashed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customerscorelog',
+            index=models.Index(fields=['customer', '-create_time'], name='customerscorelog_customer_time'),
+        ),
+    ]
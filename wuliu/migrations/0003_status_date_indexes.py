@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-16 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wuliu', '0002_customerscorelog_customerscorelog_customer_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cargopricepayment',
+            index=models.Index(fields=['status', 'create_time'], name='cargopricepayment_status_time'),
+        ),
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['status', 'create_time'], name='waybill_status_create_time'),
+        ),
+        migrations.AddIndex(
+            model_name='transportout',
+            index=models.Index(fields=['status', 'create_time'], name='transportout_status_time'),
+        ),
+        migrations.AddIndex(
+            model_name='departmentpayment',
+            index=models.Index(fields=['status', 'payment_date'], name='deptpayment_status_date'),
+        ),
+    ]
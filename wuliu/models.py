@@ -23,6 +23,31 @@ def _validate_customer_score_ratio(value):
     if value <= 0 or value > 1:
         raise ValidationError("客户积分比例必须大于0且小于等于1！")
 
+def _gen_tree_str_dic(nodes) -> dict:
+    """ 根据(id, 名称, 父节点id)序列生成各节点的层级字符串{id: tree_str}, 无需逐级查询父节点 """
+    nodes_dic = {id_: (name, father_id) for id_, name, father_id in nodes}
+    tree_str_dic = {}
+
+    def _tree_str(id_):
+        if id_ not in tree_str_dic:
+            name, father_id = nodes_dic[id_]
+            tree_str_dic[id_] = "%s %s" % (_tree_str(father_id) + " -" if father_id is not None else "", name)
+        return tree_str_dic[id_]
+
+    for id_ in nodes_dic:
+        _tree_str(id_)
+    return tree_str_dic
+
+def _get_tree_str(gen_tree_str_dic, id_) -> str:
+    """ 从带缓存的层级字符串映射中取出id_对应的层级字符串
+    该节点可能是在缓存生成之后新增的(例如由其他进程新增), 此时清除缓存后重新生成一次
+    """
+    tree_str_dic = gen_tree_str_dic()
+    if id_ not in tree_str_dic:
+        gen_tree_str_dic.cache_clear()
+        tree_str_dic = gen_tree_str_dic()
+    return tree_str_dic[id_]
+
 # 全局设置
 class Settings(models.Model):
     company_name = models.CharField("公司名称", max_length=32)
@@ -43,24 +68,28 @@ class Settings(models.Model):
 
     def save(self, *args, **kwargs):
         cls = self.__class__
-        if cls.objects.exists():
-            if cls.objects.count() != 1 or self.id != cls.objects.get().id:
-                raise Exception("只能有一个配置！")
+        # 最多取出两个已有配置的id, 一次查询即可判断
+        existed_ids = list(cls.objects.values_list("id", flat=True)[:2])
+        if existed_ids and existed_ids != [self.id]:
+            raise Exception("只能有一个配置！")
         self.full_clean()
         super().save(*args, **kwargs)
+        # 配置已变更, 清除缓存
+        get_global_settings.cache_clear()
 
 def _get_global_settings() -> Settings:
     """ 返回全局配置Settings对象, 如果没有, 则自动创建一个 """
-    try:
-        return Settings.objects.first()
-    except Settings.DoesNotExist:
+    settings_ = Settings.objects.first()
+    if settings_ is None:
         settings_ = Settings(
             company_name="PP物流",
             handling_fee_ratio=0.002,  # 千分之2
             customer_score_ratio=1,  # 每1元运费折算1分
         )
         settings_.save()
-        return settings_
+    return settings_
+
+get_global_settings = ExpireLruCache(expire_time=timezone.timedelta(hours=3))(_get_global_settings)
 
 # 权限组
 class PermissionGroup(models.Model):
@@ -76,19 +105,24 @@ class PermissionGroup(models.Model):
 
     def save(self, *args, **kwargs):
         cls = self.__class__
-        if (self.father is None
-                and cls.objects.filter(father__isnull=True).exists()
-                and self.id != cls.objects.get(father__isnull=True).id):
-            raise Exception("只能有一个根权限组！")
+        if self.father_id is None:
+            root_pg_id = cls.objects.filter(father__isnull=True).values_list("id", flat=True).first()
+            if root_pg_id is not None and root_pg_id != self.id:
+                raise Exception("只能有一个根权限组！")
         self.full_clean()
         super().save(*args, **kwargs)
+        # 层级结构可能已变更, 清除缓存
+        PermissionGroup.gen_tree_str_dic.cache_clear()
+
+    @classmethod
+    @ExpireLruCache(expire_time=timezone.timedelta(minutes=5))
+    def gen_tree_str_dic(cls) -> dict:
+        """ 一次查询生成所有权限组的层级字符串{权限组id: tree_str} (带缓存, 按类而不是按实例缓存) """
+        return _gen_tree_str_dic(cls.objects.values_list("id", "print_name", "father_id"))
 
     @cached_property
     def tree_str(self) -> str:
-        return "%s %s" % (
-            self.father.tree_str + " -" if self.father is not None else "",
-            self.print_name,
-        )
+        return _get_tree_str(PermissionGroup.gen_tree_str_dic, self.id)
 
     tree_str.short_description = "层级"
 
@@ -111,7 +145,7 @@ class Permission(models.Model):
 
     @cached_property
     def tree_str(self) -> str:
-        return "%s - %s" % (self.father.tree_str, self.print_name)
+        return "%s - %s" % (_get_tree_str(PermissionGroup.gen_tree_str_dic, self.father_id), self.print_name)
 
     tree_str.short_description = "层级"
 
@@ -150,6 +184,9 @@ class Department(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+        # 部门名称或层级结构可能已变更, 清除缓存
+        Department.get_name_map.cache_clear()
+        Department.gen_tree_str_dic.cache_clear()
 
     @cached_property
     def is_goods_yard(self) -> bool:
@@ -175,17 +212,30 @@ class Department(models.Model):
 
     @staticmethod
     @ExpireLruCache(expire_time=timezone.timedelta(minutes=5))
+    def get_name_map() -> dict:
+        """ 获取全部部门的{部门id: 部门名称}映射, 一次查询即可缓存所有部门 """
+        return dict(Department.objects.values_list("id", "name"))
+
+    @staticmethod
     def get_name_by_id(dept_id):
         """ 通过部门id获取部门名称 """
-        # 由于User的__str__方法需要频繁获取部门名称, 因此通过添加一个额外的类方法并用缓存装饰器装饰以减少开销
-        return Department.objects.get(id=dept_id).name
+        # 由于User的__str__方法需要频繁获取部门名称, 因此从带缓存的部门名称映射中获取以减少开销
+        name_map = Department.get_name_map()
+        if dept_id not in name_map:
+            # 该部门可能是在缓存生成之后新增的(例如由其他进程新增), 清除缓存后重新获取一次
+            Department.get_name_map.cache_clear()
+            name_map = Department.get_name_map()
+        return name_map[dept_id]
+
+    @classmethod
+    @ExpireLruCache(expire_time=timezone.timedelta(minutes=5))
+    def gen_tree_str_dic(cls) -> dict:
+        """ 一次查询生成所有部门的组织架构字符串{部门id: tree_str} (带缓存, 按类而不是按实例缓存) """
+        return _gen_tree_str_dic(cls.objects.values_list("id", "name", "father_department_id"))
 
     @cached_property
     def tree_str(self) -> str:
-        return "%s %s" % (
-            self.father_department.tree_str+" -" if self.father_department is not None else "",
-            self.name,
-        )
+        return _get_tree_str(Department.gen_tree_str_dic, self.id)
 
     tree_str.short_description = "组织架构"
 
@@ -296,21 +346,19 @@ class CargoPricePayment(models.Model):
     class Meta:
         verbose_name = "代收款转账单"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 搜索页面通常同时按状态和日期区间筛选
+            models.Index(fields=["status", "create_time"], name="cargopricepayment_status_time"),
+        ]
 
     def gen_total_fee(self) -> dict:
         """ 计算各项应付款金额 """
-        total_cargo_price = self.waybill_set.only("cargo_price").aggregate(_=models.Sum("cargo_price"))["_"]
-        total_deduction_fee = self.waybill_set.only("fee").filter(
-                fee_type=Waybill.FeeTypes.Deduction
-            ).aggregate(_=models.Sum("fee"))["_"]
-        total_cargo_handling_fee = self.waybill_set.only(
-                "cargo_handling_fee"
-            ).aggregate(_=models.Sum("cargo_handling_fee"))["_"]
-        return {
-            "cargo_price": total_cargo_price or 0,
-            "deduction_fee": total_deduction_fee or 0,
-            "cargo_handling_fee": total_cargo_handling_fee or 0,
-        }
+        total_fee_dic = self.waybill_set.aggregate(
+            cargo_price=Sum("cargo_price"),
+            deduction_fee=Sum("fee", filter=Q(fee_type=Waybill.FeeTypes.Deduction)),
+            cargo_handling_fee=Sum("cargo_handling_fee"),
+        )
+        return {k: v or 0 for k, v in total_fee_dic.items()}
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -417,17 +465,22 @@ class Waybill(models.Model):
     class Meta:
         verbose_name = "运单"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 搜索页面通常同时按状态和日期区间筛选
+            models.Index(fields=["status", "create_time"], name="waybill_status_create_time"),
+        ]
 
     def clean(self):
+        # 能通过外键id判断的条件不访问关联对象, 以免每次保存时额外查询数据库
         custom_validators = [
             # 发货/到货部门必须拥有发货/到货权限
             (self.src_department.enable_src, "发货部门无发货权限"),
             (self.dst_department.enable_dst, "到货部门无到货权限"),
             # 发货部门和到货部门不能一致
-            (self.src_department != self.dst_department, "发货部门和到货部门不能一致"),
+            (self.src_department_id != self.dst_department_id, "发货部门和到货部门不能一致"),
             # 若填写了发货/收货客户 则该客户必须启用
-            (self.src_customer.enabled if self.src_customer else True, "发货客户未启用"),
-            (self.dst_customer.enabled if self.dst_customer else True, "收货客户未启用"),
+            (self.src_customer.enabled if self.src_customer_id is not None else True, "发货客户未启用"),
+            (self.dst_customer.enabled if self.dst_customer_id is not None else True, "收货客户未启用"),
             # 若使用扣付, 则到货部门必须允许代收, 且运费不得高于货款
             (
                 (
@@ -443,7 +496,10 @@ class Waybill(models.Model):
                 ),
                 "扣付运费不得高于货款"
             ),
-            (self.return_waybill != self, "不能将运单作为自己的退货运单"),
+            (
+                self.return_waybill_id is None or self.return_waybill_id != self.id,
+                "不能将运单作为自己的退货运单"
+            ),
         ]
         for validator, error_text in custom_validators:
             if not validator:
@@ -463,7 +519,8 @@ class Waybill(models.Model):
 
     @cached_property
     def get_full_id(self) -> str:
-        if self.return_waybill:
+        # 只判断外键id, 避免为每个运单额外查询一次退货原运单
+        if self.return_waybill_id is not None:
             return "YF" + str(self.return_waybill_id).zfill(8)
         return str(self.id).zfill(8)
 
@@ -516,6 +573,10 @@ class TransportOut(models.Model):
     class Meta:
         verbose_name = "车次"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 搜索页面通常同时按状态和日期区间筛选
+            models.Index(fields=["status", "create_time"], name="transportout_status_time"),
+        ]
 
     def __str__(self):
         return "%s (%s)" % (self.get_full_id, self.get_status_display())
@@ -529,8 +590,8 @@ class TransportOut(models.Model):
 
     def gen_waybills_info(self):
         """ 统计该车次中配载的运单信息(单数, 件数, 总体积, 总重量) """
-        return self.waybills.only(*"pk cargo_num cargo_volume cargo_weight".split()).aggregate(
-            total_num=Count("pk"),
+        return self.waybills.aggregate(
+            total_num=Count("*"),
             total_cargo_num=Sum("cargo_num"),
             total_cargo_volume=Sum("cargo_volume"),
             total_cargo_weight=Sum("cargo_weight"),
@@ -554,17 +615,30 @@ class WaybillRouting(models.Model):
             self.waybill.get_full_id, self.get_operation_type_display()
         )
 
-    def _template_context(self) -> dict:
-        wr_transport_out = None
-        wr_return_waybill = None
+    def _related_object_ids(self) -> tuple:
+        """ 返回详细内容中需要展示的(车次id, 退货运单id), 不需要展示的为None """
         if self.operation_type in (Waybill.Statuses.GoodsYardDeparted, Waybill.Statuses.Departed):
-            wr_transport_out_id = self.operation_info.get("transport_out_id")
-            if wr_transport_out_id:
-                wr_transport_out = TransportOut.objects.get(id=wr_transport_out_id)
-        elif self.operation_type == Waybill.Statuses.Returned:
-            wr_return_waybill_id = self.operation_info.get("return_waybill_id")
-            if wr_return_waybill_id:
-                wr_return_waybill = Waybill.objects.get(id=wr_return_waybill_id)
+            return self.operation_info.get("transport_out_id") or None, None
+        if self.operation_type == Waybill.Statuses.Returned:
+            return None, self.operation_info.get("return_waybill_id") or None
+        return None, None
+
+    @staticmethod
+    def attach_related_objects(wr_list: list) -> list:
+        """ 为一组运单路由批量查询关联的车次和退货运单, 避免渲染详细内容时逐条查询 """
+        ids_list = [wr._related_object_ids() for wr in wr_list]
+        transport_outs = TransportOut.objects.select_related(
+            "src_department", "dst_department", "truck"
+        ).in_bulk({to_id for to_id, _ in ids_list if to_id is not None})
+        return_waybills = Waybill.objects.in_bulk({wb_id for _, wb_id in ids_list if wb_id is not None})
+        for wr, (to_id, wb_id) in zip(wr_list, ids_list):
+            wr._related_objects = (transport_outs.get(to_id), return_waybills.get(wb_id))
+        return wr_list
+
+    def _template_context(self) -> dict:
+        if not hasattr(self, "_related_objects"):
+            self.attach_related_objects([self])
+        wr_transport_out, wr_return_waybill = self._related_objects
         return {
             "wr": self,
             "WB_STATUSES": Waybill.Statuses,
@@ -614,39 +688,35 @@ class DepartmentPayment(models.Model):
     class Meta:
         verbose_name = "部门回款单"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 搜索页面通常同时按状态和日期区间筛选
+            models.Index(fields=["status", "payment_date"], name="deptpayment_status_date"),
+        ]
 
     @staticmethod
     def static_gen_waybills(src_department: Department, payment_date: datetime_.date) -> set:
         """ 根据应回款部门和应回款日期, 生成关联的运单id集合 """
-
-        def _date_to_datetime_start(_date):
-            return timezone.make_aware(timezone.datetime.combine(_date, datetime_.time()))
-
-        def _date_to_datetime_end(_date):
-            return timezone.make_aware(timezone.datetime.combine(_date, datetime_.time(23, 59, 59)))
-
+        # 应回款日期当天的起止时间, 只计算一次并用于两处区间筛选
+        day_range = (
+            timezone.make_aware(timezone.datetime.combine(payment_date, datetime_.time())),
+            timezone.make_aware(timezone.datetime.combine(payment_date, datetime_.time(23, 59, 59))),
+        )
         transport_out_src = TransportOut.objects.filter(
             src_department=src_department,
             status__gte=TransportOut.Statuses.OnTheWay,
-            start_time__gte=_date_to_datetime_start(payment_date),
-            start_time__lte=_date_to_datetime_end(payment_date),
+            start_time__range=day_range,
         )
         # 当天发车的运单(现付运费)
-        waybills_src = [
-            wb_id
-            for to_obj in transport_out_src
-            for wb_id in to_obj.waybills.filter(fee_type=Waybill.FeeTypes.Now).values_list("id", flat=True)
-        ]
+        waybills_src = Waybill.objects.filter(
+            transportout__in=transport_out_src, fee_type=Waybill.FeeTypes.Now,
+        ).values_list("id", flat=True)
         # 当天签收的运单
-        waybills_dst = list(
-            Waybill.objects.filter(
-                dst_department=src_department,
-                status=Waybill.Statuses.SignedFor,
-                sign_for_time__gte=_date_to_datetime_start(payment_date),
-                sign_for_time__lte=_date_to_datetime_end(payment_date),
-            ).values_list("id", flat=True)
-        )
-        return set(waybills_src + waybills_dst)
+        waybills_dst = Waybill.objects.filter(
+            dst_department=src_department,
+            status=Waybill.Statuses.SignedFor,
+            sign_for_time__range=day_range,
+        ).values_list("id", flat=True)
+        return {*waybills_src, *waybills_dst}
 
     def set_waybills_auto(self):
         """ 设置关联运单 """
@@ -658,74 +728,64 @@ class DepartmentPayment(models.Model):
         """ 计算各项应回款金额 """
         if not isinstance(waybills, QuerySet):
             waybills = Waybill.objects.filter(id__in=waybills)
-        # 发货运单: 现付运费
-        fee_now = waybills.only("fee").filter(
-                src_department=src_department, fee_type=Waybill.FeeTypes.Now,
-            ).aggregate(_=models.Sum("fee"))["_"]
-        # 签收运单: 提付运费
-        fee_sign_for = waybills.only("fee").filter(
-                dst_department=src_department, fee_type=Waybill.FeeTypes.SignFor,
-            ).aggregate(_=models.Sum("fee"))["_"]
-        # 签收运单: 代收货款
-        cargo_price = waybills.only("cargo_price").filter(
-                dst_department=src_department
-            ).aggregate(_=models.Sum("cargo_price"))["_"]
-        return {
-            "fee_now": fee_now or 0,
-            "fee_sign_for": fee_sign_for or 0,
-            "cargo_price": cargo_price or 0,
-        }
+        total_fee_dic = waybills.aggregate(
+            # 发货运单: 现付运费
+            fee_now=Sum("fee", filter=Q(src_department=src_department, fee_type=Waybill.FeeTypes.Now)),
+            # 签收运单: 提付运费
+            fee_sign_for=Sum("fee", filter=Q(dst_department=src_department, fee_type=Waybill.FeeTypes.SignFor)),
+            # 签收运单: 代收货款
+            cargo_price=Sum("cargo_price", filter=Q(dst_department=src_department)),
+        )
+        return {k: v or 0 for k, v in total_fee_dic.items()}
 
     def gen_total_fee(self) -> dict:
         """ 计算各项应回款金额 """
         return self.static_gen_total_fee(self.waybills.all(), self.src_department)
 
-    def gen_customer_score_change(self) -> list:
-        """ 计算客户积分变动 """
-        customer_score_ratio = _get_global_settings().customer_score_ratio
-        customer_score_change = []
-        filtered_waybills_info = self.waybills.filter(src_customer__is_vip=True).values(
-            "src_department_id", "dst_department_id", "src_customer_id", "id", "fee", "fee_type",
+    def gen_customer_score_change(self):
+        """ 计算客户积分变动 (生成器, 逐个产生积分变动字典) """
+        customer_score_ratio = get_global_settings().customer_score_ratio
+        # 现付运费: 应回款部门应该与运单的发货部门一致
+        # 提付或扣付运费: 应回款部门应该与运单的到达部门一致
+        q_obj = (
+            Q(fee_type=Waybill.FeeTypes.Now, src_department_id=self.src_department_id)
+            | Q(
+                fee_type__in=(Waybill.FeeTypes.Deduction, Waybill.FeeTypes.SignFor),
+                dst_department_id=self.src_department_id,
+            )
+        )
+        # 积分 = 运费 * 客户积分比例 (向上取整)
+        # 不在数据库中计算: MySQL会按DECIMAL精确计算整数运费与比例的乘积(例如100 * 0.07得到7而不是8),
+        # 结果与按双精度浮点数计算的math.ceil(fee * ratio)不一致, 从而悄悄改变客户积分
+        filtered_waybills_info = self.waybills.filter(q_obj, src_customer__is_vip=True).values(
+            "src_customer_id", "id", "fee",
         )
         for waybill_info in filtered_waybills_info:
-            fee_type = waybill_info["fee_type"]
-            # 现付运费: 应回款部门应该与运单的发货部门一致
-            # 提付或扣付运费: 应回款部门应该与运单的到达部门一致
-            if any([
-                fee_type == Waybill.FeeTypes.Now and self.src_department_id == waybill_info["src_department_id"],
-                fee_type in (Waybill.FeeTypes.Deduction, Waybill.FeeTypes.SignFor) and (
-                    self.src_department_id == waybill_info["dst_department_id"]
-                ),
-            ]):
-                customer_score_change.append({
-                    "customer_id": waybill_info["src_customer_id"],
-                    "waybill_id": waybill_info["id"],
-                    "add_score": math.ceil(waybill_info["fee"] * customer_score_ratio),
-                })
-        return customer_score_change
+            yield {
+                "customer_id": waybill_info["src_customer_id"],
+                "waybill_id": waybill_info["id"],
+                "add_score": math.ceil(waybill_info["fee"] * customer_score_ratio),
+            }
 
     def update_customer_score_change(self):
         """ 更新客户积分变动 """
-        customer_score_changes = self.gen_customer_score_change()
-        # 计算客户的总计增加积分
+        # 只遍历一次积分变动, 同时生成积分记录并计算客户的总计增加积分
         customer_add_score_total = defaultdict(int)
-        for change in customer_score_changes:
+        customer_score_logs = []
+        for change in self.gen_customer_score_change():
             customer_add_score_total[change["customer_id"]] += change["add_score"]
+            customer_score_logs.append(CustomerScoreLog(
+                customer_id=change["customer_id"],
+                inc_or_dec=True,
+                score=change["add_score"],
+                remark="运单结算",
+                waybill_id=change["waybill_id"],
+            ))
         with transaction.atomic():
-            CustomerScoreLog.objects.bulk_create([
-                CustomerScoreLog(
-                    customer_id=change["customer_id"],
-                    inc_or_dec=True,
-                    score=change["add_score"],
-                    remark="运单结算",
-                    waybill=Waybill.objects.get(id=change["waybill_id"])
-                )
-                for change in customer_score_changes
-            ])
+            CustomerScoreLog.objects.bulk_create(customer_score_logs, batch_size=500)
+            # 直接执行UPDATE语句, 无需先查询出客户对象
             for customer_id, add_score_total in customer_add_score_total.items():
-                customer = Customer.objects.get(id=customer_id)
-                customer.score = F("score") + add_score_total
-                customer.save(update_fields=["score", ])
+                Customer.objects.filter(id=customer_id).update(score=F("score") + add_score_total)
 
     @cached_property
     def get_full_id(self) -> str:
@@ -764,3 +824,7 @@ class CustomerScoreLog(models.Model):
         constraints = [
             models.CheckConstraint(check=Q(score__gte=1), name="check_change_score"),
         ]
+        indexes = [
+            # 按客户查询积分记录时, 可以直接按该索引倒序返回结果
+            models.Index(fields=["customer", "-create_time"], name="customerscorelog_customer_time"),
+        ]
@@ -1,11 +1,15 @@
 from .models import User, CargoPricePayment, Waybill, TransportOut, DepartmentPayment
 
+# 这些枚举类在进程内不会变化, 只生成一次
+# RequestContext会将返回的字典复制到自己的上下文中, 因此共享同一个字典是安全的
+_PROCESSOR_CONTEXT = {
+    "USER_TYPES": User.Types,
+    "CPP_STATUSES": CargoPricePayment.Statuses,
+    "WB_STATUSES": Waybill.Statuses,
+    "WB_FEE_TYPES": Waybill.FeeTypes,
+    "TO_STATUSES": TransportOut.Statuses,
+    "DP_STATUSES": DepartmentPayment.Statuses,
+}
+
 def pros(request):
-    return {
-        "USER_TYPES": User.Types,
-        "CPP_STATUSES": CargoPricePayment.Statuses,
-        "WB_STATUSES": Waybill.Statuses,
-        "WB_FEE_TYPES": Waybill.FeeTypes,
-        "TO_STATUSES": TransportOut.Statuses,
-        "DP_STATUSES": DepartmentPayment.Statuses,
-    }
+    return _PROCESSOR_CONTEXT
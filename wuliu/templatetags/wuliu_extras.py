@@ -1,5 +1,11 @@
+from functools import lru_cache
+from typing import NamedTuple
+
 from django import template
 from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.html import format_html
 from django.forms.fields import ChoiceField
 from django.contrib.messages import constants
 
@@ -14,29 +20,29 @@ _message_icons = {
     constants.WARNING: "fas fa-exclamation-triangle",
     constants.ERROR: "fas fa-ban",
 }
+_MESSAGE_ICON_DEFAULT = _message_icons[constants.INFO]
+_MESSAGE_HTML = (
+    '<div class="alert alert-{} {} alert-dismissible fade show text-md">'
+    '<button type="button" class="close" data-dismiss="alert" aria-hidden="true">&times;</button>'
+    '<i class="icon {}"></i> {}'
+    '</div>'
+)
 
-class _MenuItem:
-
-    __slots__ = ["name", "url", "icon", "opened", "children", "need_perm", "admin_only"]
-
-    def __init__(self, name="未命名项", url="", *,
-                 icon="far fa-circle", opened=False, children=tuple(), need_perm="", admin_only=False):
-        """
-        :param name: 页面中显示的名称
-        :param url: url
-        :param icon: 指定文字前图标的class样式
-        :param opened: 是否为已打开状态
-        :param children: 子项, 注意: 目前只能嵌套一次
-        :param need_perm: 需要的权限
-        :param admin_only: 为True时需要管理员权限
-        """
-        self.name = name
-        self.url = url
-        self.icon = icon
-        self.opened = opened
-        self.children = children
-        self.need_perm = need_perm
-        self.admin_only = admin_only
+class _MenuItem(NamedTuple):
+    """ 侧边栏菜单项, 不可变, 是否为已打开状态由每个请求单独计算
+    name: 页面中显示的名称
+    url: url
+    icon: 指定文字前图标的class样式
+    children: 子项, 注意: 目前只能嵌套一次
+    need_perm: 需要的权限
+    admin_only: 为True时需要管理员权限
+    """
+    name: str = "未命名项"
+    url: str = ""
+    icon: str = "far fa-circle"
+    children: tuple = ()
+    need_perm: str = ""
+    admin_only: bool = False
 
 def get_sidebar_menu_items():
     return [
@@ -131,6 +137,21 @@ def get_sidebar_menu_items():
         ),
     ]
 
+_sidebar_menu_items_cache = None
+# 子项url -> 需要展开的父项名称集合, 与菜单项一同生成
+_sidebar_url_to_opened_item_names = {}
+
+def _get_sidebar_menu_items_cached() -> list:
+    """ 侧边栏菜单项在进程内不会变化, 只在第一次使用时生成(调用reverse), 之后重复使用 """
+    global _sidebar_menu_items_cache
+    if _sidebar_menu_items_cache is None:
+        items = get_sidebar_menu_items()
+        for item in items:
+            for child in item.children:
+                _sidebar_url_to_opened_item_names.setdefault(child.url, set()).add(item.name)
+        _sidebar_menu_items_cache = items
+    return _sidebar_menu_items_cache
+
 @register.filter(name="is_logged_user_has_perm")
 def _is_logged_user_has_perm(perm_name, request):
     """ 检查已登录用户是否具有perm_name权限
@@ -156,31 +177,47 @@ def get_company_name():
     """ 获取公司名称 """
     return get_global_settings().company_name
 
-@register.inclusion_tag('wuliu/_inclusions/_message.html')
+@register.simple_tag()
 def show_message(message):
     """ 页面中的消息
     :param message: 消息对象
     """
-    return {
-        "message": message,
-        "icon": _message_icons.get(message.level, _message_icons[constants.INFO]),
-    }
+    return format_html(
+        _MESSAGE_HTML,
+        message.level_tag, message.extra_tags, _message_icons.get(message.level, _MESSAGE_ICON_DEFAULT), message.message,
+    )
 
 @register.inclusion_tag('wuliu/_inclusions/_sidebar_menu_items.html', takes_context=True)
 def show_sidebar_menu_items(context):
-    """ 侧边栏树状菜单 """
-    current_url = context.request.path
-    items = get_sidebar_menu_items()
-    for item in items:
+    """ 侧边栏树状菜单
+    子项的可见性(权限和管理员检查)在这里一次性计算完成, 模板中不再逐项检查
+    """
+    request = context.request
+    current_url = request.path
+    user_is_admin = get_logged_user(request).administrator
+    items = []
+    for item in _get_sidebar_menu_items_cached():
+        visible_children = []
         for child in item.children:
-            if child is None:
+            # 如果子项需要权限且用户没有该权限, 或子项需要管理员权限且用户不是管理员, 则不显示
+            if child.need_perm and not is_logged_user_has_perm(request, child.need_perm):
+                continue
+            if child.admin_only and not user_is_admin:
                 continue
-            # 根据url展开列表
-            if child.url == current_url:
-                item.opened = True
-                child.opened = True
-                break
-    return {"items": items, "request": context.request}
+            visible_children.append(child)
+        # 没有可见子项且自身没有url的菜单项不再显示
+        if not visible_children and not item.url:
+            continue
+        # 菜单项被所有请求共享, 子项全部可见时直接使用, 否则使用只包含可见子项的副本
+        if len(visible_children) != len(item.children):
+            item = item._replace(children=tuple(visible_children))
+        items.append(item)
+    return {
+        "items": items,
+        # 根据url展开列表
+        "opened_item_names": _sidebar_url_to_opened_item_names.get(current_url, ()),
+        "current_url": current_url,
+    }
 
 @register.inclusion_tag('wuliu/_inclusions/_form_input_field.html')
 def show_form_input_field(field, label="", div_class="col-md"):
@@ -202,9 +239,14 @@ def show_form_input_field_with_append_select(field, field_append, label="", div_
     :param div_class: 自定义class
     """
     assert isinstance(field_append.field, ChoiceField)
-    field_append_choices = [(str(k), v) for k, v in field_append.field.choices]
+    # 字符串化的选项列表及其字典缓存在字段对象上, 同一个表单多次渲染时不必重复生成
+    choices_cache = getattr(field_append.field, "_str_choices_cache", None)
+    if choices_cache is None:
+        field_append_choices = [(str(k), v) for k, v in field_append.field.choices]
+        choices_cache = field_append.field._str_choices_cache = (field_append_choices, dict(field_append_choices))
+    field_append_choices, field_append_choices_dic = choices_cache
     field_append_initial_value = str(field_append.value() or field_append.initial)
-    field_append_initial_string = dict(field_append_choices).get(field_append_initial_value, "")
+    field_append_initial_string = field_append_choices_dic.get(field_append_initial_value, "")
     return {
         "field": field,
         "field_append": field_append,
@@ -239,60 +281,6 @@ def show_waybill_table(waybills_info_list, table_id, have_check_box=True, high_l
         "high_light_dept_id": high_light_dept_id,
     }
 
-@register.inclusion_tag('wuliu/_inclusions/_tables/_waybill_table_row.html')
-def show_waybill_table_row(waybill_dic, table_id, have_check_box=True):
-    return {
-        "waybill": waybill_dic,
-        "table_id": table_id,
-        "have_check_box": have_check_box,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_stock_waybill_table.html')
-def show_stock_waybill_table(waybills_info_list, table_id):
-    return {
-        "waybills_info_list": waybills_info_list,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_dst_stock_waybill_table.html')
-def show_dst_stock_waybill_table(waybills_info_list, table_id):
-    return {
-        "waybills_info_list": waybills_info_list,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_transport_out_table.html')
-def show_transport_out_table(transport_out_list, table_id):
-    return {
-        "transport_out_list": transport_out_list,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_department_payment_table.html')
-def show_department_payment_table(department_payment_list, table_id):
-    return {
-        "department_payment_list": department_payment_list,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_cargo_price_payment_table.html')
-def show_cargo_price_payment_table(cargo_price_payment_list, table_id):
-    return {
-        "cargo_price_payment_list": cargo_price_payment_list,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_tables/_customer_score_log_table.html')
-def show_customer_score_log_table(customer_score_logs, table_id):
-    return {
-        "customer_score_logs": customer_score_logs,
-        "table_id": table_id,
-    }
-
-@register.inclusion_tag('wuliu/_inclusions/_sign_for_waybill_info.html')
-def show_sign_for_waybill_info(waybill_info_dic):
-    return {"waybill": waybill_info_dic}
-
 @register.inclusion_tag('wuliu/_inclusions/_permission_tree.html')
 def _show_permission_tree(list_):
     """ 权限树图(递归使用) """
@@ -303,7 +291,27 @@ def show_full_permission_tree(div_id):
     """ 完整的权限树图(附js) """
     return {"div_id": div_id, "list": PERMISSION_TREE_LIST}
 
-@register.inclusion_tag('wuliu/_inclusions/_js/_export_table_to_excel.js.html')
+# 以下两个js代码片段的内容只取决于标签参数, 而参数在模板中基本都是常量, 因此渲染结果按参数缓存在进程内
+
+@lru_cache(maxsize=64)
+def _render_js_export_table_to_excel(table_id, button_css_selector, skip_td_num, table_title, min_time_interval):
+    return mark_safe(render_to_string("wuliu/_inclusions/_js/_export_table_to_excel.js.html", {
+        "table_id": table_id,
+        "button_css_selector": button_css_selector,
+        "skip_td_num": skip_td_num,
+        "table_title": table_title,
+        "min_time_interval": min_time_interval,
+    }))
+
+@lru_cache(maxsize=64)
+def _render_js_init_datatable(table_id, have_check_box, custom_fixed_columns_left):
+    return mark_safe(render_to_string("wuliu/_inclusions/_js/_init_datatable.js.html", {
+        "table_id": table_id,
+        "have_check_box": have_check_box,
+        "custom_fixed_columns_left": custom_fixed_columns_left
+    }))
+
+@register.simple_tag()
 def js_export_table_to_excel(table_id, button_css_selector, skip_td_num=1,
                              table_title="", table_title_is_js=False, min_time_interval=60):
     """ 导出(excel表格)功能的js实现代码, 外层已被<script>标签包裹, 不要重复添加
@@ -317,15 +325,9 @@ def js_export_table_to_excel(table_id, button_css_selector, skip_td_num=1,
     """
     if table_title and not table_title_is_js:
         table_title = '"%s"' % table_title.replace('\"', "").replace("\'", "")
-    return {
-        "table_id": table_id,
-        "button_css_selector": button_css_selector,
-        "skip_td_num": skip_td_num,
-        "table_title": table_title,
-        "min_time_interval": min_time_interval,
-    }
+    return _render_js_export_table_to_excel(table_id, button_css_selector, skip_td_num, table_title, min_time_interval)
 
-@register.inclusion_tag('wuliu/_inclusions/_js/_init_datatable.js.html')
+@register.simple_tag()
 def js_init_datatable(table_id, have_check_box=True, custom_fixed_columns_left=None):
     """ 初始化DataTable的js实现代码(初始化, 全选, 添加序号), 外层已被<script>标签包裹, 不要重复添加
     :param table_id: DataTables对象的id属性
@@ -333,8 +335,4 @@ def js_init_datatable(table_id, have_check_box=True, custom_fixed_columns_left=N
     :param custom_fixed_columns_left: 自定义表格左侧固定显示的列数,
                                       为None时则冻结两列(如果have_check_box为True则同时固定第二列的复选框)
     """
-    return {
-        "table_id": table_id,
-        "have_check_box": have_check_box,
-        "custom_fixed_columns_left": custom_fixed_columns_left
-    }
+    return _render_js_init_datatable(table_id, have_check_box, custom_fixed_columns_left)
@@ -2,7 +2,6 @@ from django.urls import path, include
 
 from . import views, apis
 
-# Unused
 def easy_path(view_func):
     """ 只需给定视图函数, route和name都设置为视图函数的名字 """
     return path(view_func.__name__, view_func, name=view_func.__name__)
@@ -10,17 +9,17 @@ def easy_path(view_func):
 app_name = "wuliu"
 urlpatterns = [
     # 登录
-    path("login", views.login, name="login"),
-    path("logout", views.logout, name="logout"),
-    path("change_password", views.change_password, name="change_password"),
+    easy_path(views.login),
+    easy_path(views.logout),
+    easy_path(views.change_password),
     path("", views.welcome, name="welcome"),
     path("welcome_action.js", views.welcome_js, name="welcome_js"),
     # 系统设置
     path("settings/", include([
-        path("manage_users", views.manage_users, name="manage_users"),
-        path("add_user", views.add_user, name="add_user"),
-        path("manage_user_permission", views.manage_user_permission, name="manage_user_permission"),
-        path("batch_edit_user_permission", views.batch_edit_user_permission, name="batch_edit_user_permission"),
+        easy_path(views.manage_users),
+        easy_path(views.add_user),
+        easy_path(views.manage_user_permission),
+        easy_path(views.batch_edit_user_permission),
     ])),
     # 运单管理
     path("waybill/", include([
@@ -1,31 +1,36 @@
 import datetime as datetime_
+from functools import lru_cache
+from itertools import chain
 
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.hashers import check_password, make_password
 from django.core.exceptions import ValidationError
-from django.http import HttpResponseBadRequest, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
+from django.utils.crypto import get_random_string
 from django.views import View
 from django.views.decorators.http import require_POST
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q, Count, Sum
+from django.db.models import Q, Count, Sum, Prefetch
 from django.core.signals import got_request_exception
 
 from . import forms
 from .models import (
     User, Waybill, Department, WaybillRouting, TransportOut, DepartmentPayment, CargoPricePayment, CustomerScoreLog
 )
+from .processor import pros
 from .common import (
     get_global_settings, login_required, check_permission, check_administrator, is_logged_user_has_perm,
     get_logged_user, get_logged_user_type, is_logged_user_is_goods_yard,
     department_payment_to_dict, cargo_price_payment_to_dict,
 )
-from utils.common import del_session_item, validate_comma_separated_integer_list_and_split
+from utils.common import ExpireLruCache, del_session_item, validate_comma_separated_integer_list_and_split
 
 
 class WaybillSearchView(View):
@@ -35,12 +40,13 @@ class WaybillSearchView(View):
     need_login = True
     need_permissions = ()
 
-    def __init__(self, *args, **kwargs):
-        assert getattr(self, "template_name"), (
+    def __init_subclass__(cls, **kwargs):
+        # 在定义子类时检查一次即可, 不必在每次请求实例化视图时检查
+        super().__init_subclass__(**kwargs)
+        assert getattr(cls, "template_name"), (
             "Subclasses inherited must specify the 'template_name' property when defining!"
         )
-        assert isinstance(self.form_class(), forms.WaybillSearchForm)
-        super().__init__(*args, **kwargs)
+        assert issubclass(cls.form_class, forms.WaybillSearchForm)
 
     def get(self, request, *args, **kwargs):
         return render(
@@ -127,6 +133,46 @@ def _transport_out_search_view(request, render_path, search_mode):
             }
         )
 
+def _message_submit_failed(request, form, custom_error_messages: list):
+    """ 以一条错误消息提示提交失败, 内容包括表单的全部错误以及自定义的错误信息 """
+    messages.error(request, mark_safe("<br>".join(chain(
+        ("提交失败！", ),
+        ("%s: %s" % (k, "".join(v)) for k, v in form.errors.items()),
+        custom_error_messages,
+    ))))
+
+def _waybills_in_order(waybill_ids: list) -> list:
+    """ 根据运单id列表一次性查出运单(连同发货部门和到达部门), 并按照id列表的顺序返回 """
+    waybills_by_id = {
+        wb.id: wb for wb in Waybill.objects.filter(id__in=waybill_ids).select_related("src_department", "dst_department")
+    }
+    return [waybills_by_id[wb_id] for wb_id in waybill_ids if wb_id in waybills_by_id]
+
+@lru_cache(maxsize=None)
+def _reverse_static(viewname: str) -> str:
+    """ 不带参数的路由的反向解析结果在进程内不会变化, 只解析一次 """
+    return reverse(viewname)
+
+# 部分js模板的内容与请求无关(至多取决于少量参数), 渲染结果按模板名和参数缓存在进程内
+@lru_cache(maxsize=16)
+def _render_static_js(template_name: str, **context) -> str:
+    # 不经过RequestContext渲染, 因此手动补上上下文处理器提供的变量
+    return render_to_string(template_name, {**pros(None), **context})
+
+def _static_js_response(template_name: str, **context) -> HttpResponse:
+    return HttpResponse(_render_static_js(template_name, **context), content_type="text/javascript")
+
+_dummy_password_hash = None
+
+def _check_dummy_password(password):
+    """ 用户不存在时也进行一次同等开销的密码校验, 使响应时间无法用于判断用户名是否存在
+    用于比对的哈希值只在第一次使用时生成
+    """
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = make_password(get_random_string(12))
+    check_password(password, _dummy_password_hash)
+
 def login(request):
 
     def _login_abort(message_text):
@@ -141,8 +187,11 @@ def login(request):
         username = request.POST.get('username')
         password = request.POST.get('password')
         try:
-            user = User.objects.get(name=username)
+            user = User.objects.select_related("department").only(
+                "id", "name", "password", "enabled", "department__name"
+            ).get(name=username)
         except User.DoesNotExist:
+            _check_dummy_password(password)
             return _login_abort('用户名或密码错误，请重新输入！')
         if not user.enabled:
             return _login_abort('该用户未被启用，请联系管理员！')
@@ -158,104 +207,130 @@ def login(request):
         return redirect("wuliu:welcome")
 
 def logout(request):
+    # 会话清空后, SessionMiddleware会在响应中删除会话cookie
     request.session.flush()
-    request.COOKIES.clear()
     return redirect("wuliu:login")
 
-@login_required()
-def welcome(request):
-    # messages.debug(request, "Test debug message...")
-    # messages.info(request, "Test info message...")
-    # messages.success(request, "Test success message...")
-    # messages.warning(request, "Test warning message...")
-    # messages.error(request, "Test error message...")
-    logged_user_type = get_logged_user_type(request)
+_WEEKDAY_NAMES = ("周一", "周二", "周三", "周四", "周五", "周六", "周日")
+
+@ExpireLruCache(expire_time=timezone.timedelta(minutes=1))
+def _gen_welcome_statistics(logged_user_type: User.Types, department_id) -> tuple:
+    """ 生成欢迎页面中的统计数据, 结果按(用户类型, 部门)缓存1分钟
+    日期不作为缓存参数, 因为过期的缓存项不会被主动删除, 否则每天都会新增一批缓存项
+    1分钟的过期时间足以限制跨日时的误差
+    :param department_id: 管理员和公司统计全部部门, 应传入None以共享同一份缓存
+    :return: (今日/待处理统计字典, 14天内每天新增运单数列表, 14天内每天运费收入列表)
+    """
+    today = datetime_.date.today()
     dic = {
         "today": {"waybill": 0, "transport_out": 0, "arrival": 0, "sign_for": 0},
         "wait": {"waybill": 0, "transport_out": 0, "arrival": 0, "sign_for": 0},
     }
     today_start_datetime = timezone.make_aware(
-        timezone.datetime.combine(datetime_.date.today(), datetime_.time(0, 0))
-    )
-    today_end_datetime = timezone.make_aware(
-        timezone.datetime.combine(datetime_.date.today(), datetime_.time(23, 59, 59))
+        timezone.datetime.combine(today, datetime_.time(0, 0))
     )
-    today_weekday = timezone.now().isoweekday()
-    weekdays = [
-        {1: "周一", 2: "周二", 3: "周三", 4: "周四", 5: "周五", 6: "周六", 7: "周日"}.get(
-            today_weekday-i if today_weekday-i > 0 else today_weekday+7-i
-        )
-        for i in range(7)[::-1]
-    ]
+    today_end_datetime = today_start_datetime + timezone.timedelta(days=1, seconds=-1)
     # 14天内每天新增运单数和运费收入
     # 分支机构和货场只统计自己部门的新增运单数(虽然货场没有开票权限...)
     if logged_user_type == User.Types.GoodsYard:
         waybill_num_in_past_two_weeks = [0] * 14
         waybill_fee_in_past_two_weeks = [0] * 14
     else:
-        waybill_num_in_past_two_weeks = []
-        waybill_fee_in_past_two_weeks = []
+        queryset = Waybill.objects.filter(
+            create_time__gte=today_start_datetime - timezone.timedelta(days=13),
+            create_time__lte=today_end_datetime,
+        ).exclude(status=Waybill.Statuses.Dropped)
+        if logged_user_type == User.Types.Branch:
+            queryset = queryset.filter(src_department__id=department_id)
+        # 使用条件聚合在一次查询中得到每一天的统计结果(不使用TruncDate, 以免依赖数据库的时区表)
+        day_filters = []
         for i in range(14)[::-1]:
-            queryset = Waybill.objects.only("pk", "fee").filter(
-                    create_time__gte=today_start_datetime - timezone.timedelta(days=i),
-                    create_time__lte=today_end_datetime - timezone.timedelta(days=i),
-                ).exclude(status=Waybill.Statuses.Dropped)
-            if logged_user_type == User.Types.Branch:
-                queryset = queryset.filter(src_department__id=request.session["user"]["department_id"])
-            day_info = queryset.aggregate(fee_total=Sum("fee"), count=Count("pk"))
-            waybill_num_in_past_two_weeks.append(day_info["count"])
-            waybill_fee_in_past_two_weeks.append(day_info["fee_total"] or 0)
+            days_ago = timezone.timedelta(days=i)
+            day_filters.append(Q(
+                create_time__gte=today_start_datetime - days_ago, create_time__lte=today_end_datetime - days_ago,
+            ))
+        days_info = queryset.aggregate(
+            **{"count_%d" % i: Count("pk", filter=q) for i, q in enumerate(day_filters)},
+            **{"fee_total_%d" % i: Sum("fee", filter=q) for i, q in enumerate(day_filters)},
+        )
+        waybill_num_in_past_two_weeks = [days_info["count_%d" % i] for i in range(14)]
+        waybill_fee_in_past_two_weeks = [days_info["fee_total_%d" % i] or 0 for i in range(14)]
     # 今日新增
     dic["today"]["waybill"] = waybill_num_in_past_two_weeks[-1]
+    # 管理员和公司统计全部部门, 分支机构和货场只统计本部门
+    if logged_user_type in (User.Types.Administrator, User.Types.Company):
+        src_department_q = dst_department_q = Q()
+    else:
+        src_department_q = Q(src_department__id=department_id)
+        dst_department_q = Q(dst_department__id=department_id)
+    # 以下统计按模型分别合并为一次条件聚合查询
     # 今日发车
-    today_transport_out = TransportOut.objects.filter(
+    today_transport_out_q = Q(
         start_time__gte=today_start_datetime,
         start_time__lte=today_end_datetime,
         status__in=(TransportOut.Statuses.OnTheWay, TransportOut.Statuses.Arrived),
+    ) & src_department_q
+    # 待到车
+    wait_arrival_q = Q(status=TransportOut.Statuses.OnTheWay) & dst_department_q
+    transport_out_info = TransportOut.objects.filter(today_transport_out_q | wait_arrival_q).aggregate(
+        today_transport_out=Count("waybills", filter=today_transport_out_q),
+        wait_arrival=Count("pk", filter=wait_arrival_q, distinct=True),
     )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_transport_out = today_transport_out.filter(src_department__id=request.session["user"]["department_id"])
-    dic["today"]["transport_out"] = today_transport_out.aggregate(_=Count("waybills"))["_"] or 0
     # 今日到货
-    today_arrival = Waybill.objects.filter(
-        arrival_time__gte=today_start_datetime, arrival_time__lte=today_end_datetime,
-    )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_arrival = today_arrival.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["today"]["arrival"] = today_arrival.count() or 0
+    today_arrival_q = Q(arrival_time__gte=today_start_datetime, arrival_time__lte=today_end_datetime) & dst_department_q
     # 今日签收
-    today_sign_for = Waybill.objects.filter(
-        sign_for_time__gte=today_start_datetime, sign_for_time__lte=today_end_datetime,
-    )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_sign_for = today_sign_for.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["today"]["sign_for"] = today_sign_for.count()
-    # 待确认订单
-    dic["wait"]["waybill"] = 0
+    today_sign_for_q = Q(sign_for_time__gte=today_start_datetime, sign_for_time__lte=today_end_datetime) & dst_department_q
     # 待发车
     if logged_user_type == User.Types.GoodsYard:
-        dic["wait"]["transport_out"] = Waybill.objects.filter(
-                status__in=(Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.GoodsYardLoaded)
-            ).count()
+        wait_transport_out_q = Q(status__in=(Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.GoodsYardLoaded))
     elif logged_user_type == User.Types.Branch:
-        dic["wait"]["transport_out"] = Waybill.objects.filter(
-                src_department__id=request.session["user"]["department_id"],
-                status__in=(Waybill.Statuses.Created, Waybill.Statuses.Loaded),
-            ).count()
+        wait_transport_out_q = Q(status__in=(Waybill.Statuses.Created, Waybill.Statuses.Loaded)) & src_department_q
     else:
-        dic["wait"]["transport_out"] = Waybill.objects.filter(
-                status__in=(Waybill.Statuses.Created, Waybill.Statuses.Loaded)
-            ).count()
-    # 待到车
-    wait_arrival = TransportOut.objects.filter(status=TransportOut.Statuses.OnTheWay)
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        wait_arrival = wait_arrival.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["wait"]["arrival"] = wait_arrival.count()
+        wait_transport_out_q = Q(status__in=(Waybill.Statuses.Created, Waybill.Statuses.Loaded))
     # 待签收
-    wait_sign_for = Waybill.objects.filter(status=Waybill.Statuses.Arrived)
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        wait_sign_for = wait_sign_for.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["wait"]["sign_for"] = wait_sign_for.count()
+    wait_sign_for_q = Q(status=Waybill.Statuses.Arrived) & dst_department_q
+    waybill_info = Waybill.objects.filter(
+        today_arrival_q | today_sign_for_q | wait_transport_out_q | wait_sign_for_q
+    ).aggregate(
+        today_arrival=Count("pk", filter=today_arrival_q),
+        today_sign_for=Count("pk", filter=today_sign_for_q),
+        wait_transport_out=Count("pk", filter=wait_transport_out_q),
+        wait_sign_for=Count("pk", filter=wait_sign_for_q),
+    )
+    dic["today"]["transport_out"] = transport_out_info["today_transport_out"]
+    dic["today"]["arrival"] = waybill_info["today_arrival"]
+    dic["today"]["sign_for"] = waybill_info["today_sign_for"]
+    # 待确认订单
+    dic["wait"]["waybill"] = 0
+    dic["wait"]["transport_out"] = waybill_info["wait_transport_out"]
+    dic["wait"]["arrival"] = transport_out_info["wait_arrival"]
+    dic["wait"]["sign_for"] = waybill_info["wait_sign_for"]
+
+    return dic, waybill_num_in_past_two_weeks, waybill_fee_in_past_two_weeks
+
+@login_required()
+def welcome(request):
+    # messages.debug(request, "Test debug message...")
+    # messages.info(request, "Test info message...")
+    # messages.success(request, "Test success message...")
+    # messages.warning(request, "Test warning message...")
+    # messages.error(request, "Test error message...")
+    logged_user_type = get_logged_user_type(request)
+    today_weekday = timezone.now().isoweekday()
+    weekdays = [_WEEKDAY_NAMES[(today_weekday - 1 - i) % 7] for i in range(7)[::-1]]
+    # 管理员和公司统计全部部门, 与所属部门无关
+    if logged_user_type in (User.Types.Administrator, User.Types.Company):
+        department_id = None
+    else:
+        department_id = request.session["user"]["department_id"]
+    dic, waybill_num_in_past_two_weeks, waybill_fee_in_past_two_weeks = _gen_welcome_statistics(
+        logged_user_type, department_id
+    )
+
+    waybill_num_last_week, waybill_num_this_week = waybill_num_in_past_two_weeks[:7], waybill_num_in_past_two_weeks[7:]
+    waybill_fee_last_week, waybill_fee_this_week = waybill_fee_in_past_two_weeks[:7], waybill_fee_in_past_two_weeks[7:]
+    waybill_num_last_week_total, waybill_num_this_week_total = sum(waybill_num_last_week), sum(waybill_num_this_week)
+    waybill_fee_last_week_total, waybill_fee_this_week_total = sum(waybill_fee_last_week), sum(waybill_fee_this_week)
 
     return render(
         request,
@@ -263,23 +338,19 @@ def welcome(request):
         {
             "data_dic": dic,
             "weekdays": weekdays,
-            "waybill_num_last_week": waybill_num_in_past_two_weeks[:7],
-            "waybill_num_this_week": waybill_num_in_past_two_weeks[7:],
-            "waybill_num_this_week_total": sum(waybill_num_in_past_two_weeks[7:]),
+            "waybill_num_last_week": waybill_num_last_week,
+            "waybill_num_this_week": waybill_num_this_week,
+            "waybill_num_this_week_total": waybill_num_this_week_total,
             "waybill_num_change_rate_percentage": (
-                (sum(waybill_num_in_past_two_weeks[7:]) / sum(waybill_num_in_past_two_weeks[:7]) - 1) * 100
-                if sum(waybill_num_in_past_two_weeks[:7]) else (
-                    100 if sum(waybill_num_in_past_two_weeks[7:]) else 0
-                )
+                (waybill_num_this_week_total / waybill_num_last_week_total - 1) * 100
+                if waybill_num_last_week_total else (100 if waybill_num_this_week_total else 0)
             ),
-            "waybill_fee_last_week": waybill_fee_in_past_two_weeks[:7],
-            "waybill_fee_this_week": waybill_fee_in_past_two_weeks[7:],
-            "waybill_fee_this_week_total": sum(waybill_fee_in_past_two_weeks[7:]),
+            "waybill_fee_last_week": waybill_fee_last_week,
+            "waybill_fee_this_week": waybill_fee_this_week,
+            "waybill_fee_this_week_total": waybill_fee_this_week_total,
             "waybill_fee_change_rate_percentage": (
-                (sum(waybill_fee_in_past_two_weeks[7:]) / sum(waybill_fee_in_past_two_weeks[:7]) - 1) * 100
-                if sum(waybill_fee_in_past_two_weeks[:7]) else (
-                    100 if sum(waybill_fee_in_past_two_weeks[7:]) else 0
-                )
+                (waybill_fee_this_week_total / waybill_fee_last_week_total - 1) * 100
+                if waybill_fee_last_week_total else (100 if waybill_fee_this_week_total else 0)
             ),
         }
     )
@@ -305,14 +376,7 @@ def change_password(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:change_password")
 
         if not form.is_valid():
@@ -350,14 +414,7 @@ def manage_users(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:manage_users")
 
         if not form.is_valid():
@@ -376,9 +433,12 @@ def manage_users(request):
                 user.enabled = form_cleaned_data["enabled"]
                 user.administrator = form_cleaned_data["administrator"]
                 user.department = user_dept
+                update_fields = ["enabled", "administrator", "department"]
                 if reset_password_flag:
                     user.password = make_password(form_cleaned_data["reset_password"])
-                user.save()
+                    update_fields.append("password")
+                # 仍然通过save方法保存, 以保留其中"至少要有一个管理员用户"的检查
+                user.save(update_fields=update_fields)
         except Exception as e:
             got_request_exception.send(None, request=request)
             custom_error_messages.append(str(e))
@@ -399,14 +459,7 @@ def add_user(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:add_user")
 
         if not form.is_valid():
@@ -437,14 +490,7 @@ def manage_user_permission(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:manage_user_permission")
 
         if not form.is_valid():
@@ -479,30 +525,31 @@ def batch_edit_user_permission(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:batch_edit_user_permission")
 
         if not form.is_valid():
             return _failed()
         form_cleaned_data = form.cleaned_data
-        users = form_cleaned_data["user"]
-        permission_queryset_ids = form_cleaned_data["permission"].values_list("id", flat=True)
+        user_ids = list(form_cleaned_data["user"].values_list("id", flat=True))
+        permission_ids = list(form_cleaned_data["permission"].values_list("id", flat=True))
         is_grant = form.cleaned_data["grant_or_deny"]
+        # 直接操作多对多关系的中间表, 所有用户的权限变更只需一条语句
+        user_permission_through = User.permission.through
         try:
             with transaction.atomic():
                 if is_grant:
-                    for user in users:
-                        user.permission.add(*permission_queryset_ids)
+                    user_permission_through.objects.bulk_create(
+                        [
+                            user_permission_through(user_id=user_id, permission_id=permission_id)
+                            for user_id in user_ids for permission_id in permission_ids
+                        ],
+                        ignore_conflicts=True,
+                    )
                 else:
-                    for user in users:
-                        user.permission.remove(*permission_queryset_ids)
+                    user_permission_through.objects.filter(
+                        user_id__in=user_ids, permission_id__in=permission_ids
+                    ).delete()
         except Exception as e:
             got_request_exception.send(None, request=request)
             custom_error_messages.append(str(e))
@@ -520,14 +567,7 @@ def add_waybill(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return render(request, 'wuliu/waybill/add_waybill.html', {"form": form})
 
         form = forms.WaybillForm(request.POST)
@@ -538,6 +578,7 @@ def add_waybill(request):
         except AssertionError as e:
             custom_error_messages.append(str(e))
             return _failed()
+        logged_user = get_logged_user(request)
         try:
             with transaction.atomic():
                 new_waybill = form.save()
@@ -548,8 +589,8 @@ def add_waybill(request):
                     waybill=new_waybill,
                     time=new_waybill.create_time,
                     operation_type=Waybill.Statuses.Created,
-                    operation_dept=get_logged_user(request).department,
-                    operation_user=get_logged_user(request),
+                    operation_dept_id=logged_user.department_id,
+                    operation_user=logged_user,
                 )
         except ValidationError as e:
             custom_error_messages += e.messages
@@ -591,14 +632,7 @@ def edit_waybill(request):
         form = forms.WaybillForm(request.POST)
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             form.add_id_field(id_=waybill_id, id_full=waybill_id_full)
             return render(request, 'wuliu/waybill/edit_waybill.html', {"form": form})
 
@@ -655,7 +689,14 @@ def detail_waybill(request, waybill_id):
     form.add_id_field(id_=waybill.id, id_full=waybill.get_full_id)
     form.change_to_detail_form()
     wb_routing = WaybillRouting.objects.filter(waybill_id=waybill_id)
-    wb_routing = wb_routing.select_related("operation_dept", "operation_user")
+    wb_routing = wb_routing.select_related("operation_dept", "operation_user").only(
+        "time", "operation_type", "operation_info", "waybill_id",
+        "operation_dept", "operation_dept__name", "operation_user", "operation_user__name",
+    )
+    wb_routing = WaybillRouting.attach_related_objects(list(wb_routing))
+    # 所有路由都属于同一个运单, 直接使用已经查询出的运单对象, 不必在查询路由时再联表查询运单
+    for wr in wb_routing:
+        wr.waybill = waybill
     if waybill.cargo_price > 0:
         wb_final_cpp_fee = waybill.cargo_price - waybill.cargo_handling_fee - (
             waybill.fee if waybill.fee_type == Waybill.FeeTypes.Deduction else 0
@@ -719,13 +760,14 @@ def confirm_return_waybill(request):
     def _check_waybill(waybill_):
         assert waybill_.dst_department_id == request.session["user"]["department_id"], "禁止跨部门操作运单"
         assert waybill_.status == Waybill.Statuses.Arrived, "只允许对到站待提状态的运单进行退货操作"
-        assert waybill_.return_waybill is None, "退货运单禁止再次进行退货操作"
+        assert waybill_.return_waybill_id is None, "退货运单禁止再次进行退货操作"
 
     if request.method == "GET":
         waybill_id = request.GET.get("waybill_id")
         if not waybill_id:
             return HttpResponseBadRequest()
-        waybill = get_object_or_404(Waybill, pk=waybill_id)
+        # 页面中要显示发货部门名称
+        waybill = get_object_or_404(Waybill.objects.select_related("src_department"), pk=waybill_id)
         try:
             _check_waybill(waybill)
         except AssertionError as exc:
@@ -739,7 +781,11 @@ def confirm_return_waybill(request):
     if request.method == "POST":
         return_waybill_id = request.POST.get("return_waybill_id")
         return_reason = request.POST.get("return_reason").strip()
-        waybill = get_object_or_404(Waybill, pk=return_waybill_id)
+        # 退货运单由原始运单的部门和客户交换而来, 且两个运单保存时的校验都会用到这些外键对象, 因此一并查询
+        waybill = get_object_or_404(
+            Waybill.objects.select_related("src_department", "dst_department", "src_customer", "dst_customer"),
+            pk=return_waybill_id,
+        )
         try:
             _check_waybill(waybill)
         except AssertionError as exc:
@@ -748,10 +794,11 @@ def confirm_return_waybill(request):
         if not return_reason:
             messages.error(request, "请仔细填写退货原因！")
             return redirect("%s?%s" % (
-                reverse("wuliu:confirm_return_waybill"),
+                _reverse_static("wuliu:confirm_return_waybill"),
                 urlencode({"waybill_id": return_waybill_id})
             ))
         timezone_now = timezone.now()
+        logged_user = get_logged_user(request)
         try:
             with transaction.atomic():
                 returned_waybill = Waybill.objects.create(
@@ -778,24 +825,28 @@ def confirm_return_waybill(request):
                     fee_type=Waybill.FeeTypes.SignFor,  # 退货运单运费强制设置为提付
                     return_waybill=waybill,
                 )
-                returned_waybill.waybillrouting_set.create(
-                    # waybill=waybill,
-                    time=timezone_now,
-                    operation_type=Waybill.Statuses.Created,
-                    operation_dept=get_logged_user(request).department,
-                    operation_user=get_logged_user(request),
-                    operation_info={"return_reason": return_reason},
-                )
                 waybill.status = Waybill.Statuses.Returned
-                waybill.save()
-                waybill.waybillrouting_set.create(
-                    # waybill=waybill,
-                    time=timezone_now,
-                    operation_type=Waybill.Statuses.Returned,
-                    operation_dept=get_logged_user(request).department,
-                    operation_user=get_logged_user(request),
-                    operation_info={"return_reason": return_reason, "return_waybill_id": returned_waybill.id},
-                )
+                # Waybill.save()还会重新计算冗余字段cargo_price_status, 因此一并写入
+                waybill.save(update_fields=["status", "cargo_price_status"])
+                # 退货运单的"开票"路由和原始运单的"退货"路由一并插入
+                WaybillRouting.objects.bulk_create([
+                    WaybillRouting(
+                        waybill=returned_waybill,
+                        time=timezone_now,
+                        operation_type=Waybill.Statuses.Created,
+                        operation_dept_id=logged_user.department_id,
+                        operation_user=logged_user,
+                        operation_info={"return_reason": return_reason},
+                    ),
+                    WaybillRouting(
+                        waybill=waybill,
+                        time=timezone_now,
+                        operation_type=Waybill.Statuses.Returned,
+                        operation_dept_id=logged_user.department_id,
+                        operation_user=logged_user,
+                        operation_info={"return_reason": return_reason, "return_waybill_id": returned_waybill.id},
+                    ),
+                ])
         except Exception as e:
             if settings.DEBUG:
                 raise
@@ -803,7 +854,7 @@ def confirm_return_waybill(request):
             messages.error(request, str(e))
             messages.error(request, "保存数据库失败，请联系管理员！")
             return redirect("%s?%s" % (
-                reverse("wuliu:confirm_return_waybill"),
+                _reverse_static("wuliu:confirm_return_waybill"),
                 urlencode({"waybill_id": return_waybill_id}),
             ))
         messages.success(request, mark_safe('退货提交成功，退货运单单号【<a href="%s">%s</a>】' % (
@@ -824,32 +875,26 @@ def add_transport_out(request):
             "edit_transport_out__waybills_ready_to_add",
             "edit_transport_out__waybills_added",
         )
-        waybills_added = [int(wb_id) for wb_id in request.session.get("add_transport_out__waybills_added", [])]
+        # 只在列表发生变化时才写回会话, 避免无谓地保存会话
+        waybills_added_old = request.session.get("add_transport_out__waybills_added")
+        waybills_added = [int(wb_id) for wb_id in waybills_added_old or []]
         waybills_add = [int(wb_id) for wb_id in request.session.pop("add_transport_out__waybills_ready_to_add", [])]
-        waybills_added = sorted(set(waybills_added) | set(waybills_add), key=int)
-        request.session["add_transport_out__waybills_added"] = waybills_added
+        waybills_added = sorted({*waybills_added, *waybills_add})
+        if waybills_added != waybills_added_old:
+            request.session["add_transport_out__waybills_added"] = waybills_added
         return render(
             request,
             'wuliu/transport_out/add_transport_out.html',
             {
                 "form": form,
-                "waybills_info_list": Waybill.objects.filter(
-                        id__in=waybills_added
-                    ).select_related("src_department", "dst_department"),
+                "waybills_info_list": _waybills_in_order(waybills_added),
             }
         )
     if request.method == "POST":
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:add_transport_out")
 
         form = forms.TransportOutForm(request.POST)
@@ -897,27 +942,30 @@ def edit_transport_out(request):
         form.add_id_field(id_=transport_out_id, id_full=transport_out.get_full_id)
         # 会话操作
         del_session_item(request, "add_transport_out__waybills_ready_to_add", "add_transport_out__waybills_added")
-        if int(request.session.get("edit_transport_out__transport_out_id", -1)) != int(transport_out_id):
+        # 只在数据发生变化时才写回会话, 避免无谓地保存会话
+        # 会话中保存的车次id本身就是整数, 直接与已查出的车次id比较
+        if request.session.get("edit_transport_out__transport_out_id") != transport_out.id:
             del_session_item(
                 request,
                 "edit_transport_out__waybills_ready_to_add",
                 "edit_transport_out__waybills_added",
             )
-        request.session["edit_transport_out__transport_out_id"] = int(transport_out_id)
-        waybills_added = request.session.get(
-            "edit_transport_out__waybills_added", list(transport_out.waybills.values_list("id", flat=True))
-        )
+            request.session["edit_transport_out__transport_out_id"] = transport_out.id
+        waybills_added_old = request.session.get("edit_transport_out__waybills_added")
+        if waybills_added_old is None:
+            waybills_added = list(transport_out.waybills.values_list("id", flat=True))
+        else:
+            waybills_added = waybills_added_old
         waybills_add = [int(wb_id) for wb_id in request.session.pop("edit_transport_out__waybills_ready_to_add", [])]
-        waybills_added = sorted(set(waybills_added) | set(waybills_add), key=int)
-        request.session["edit_transport_out__waybills_added"] = waybills_added
+        waybills_added = sorted({*waybills_added, *waybills_add})
+        if waybills_added != waybills_added_old:
+            request.session["edit_transport_out__waybills_added"] = waybills_added
         return render(
             request,
             'wuliu/transport_out/edit_transport_out.html',
             {
                 "form": form,
-                "waybills_info_list": Waybill.objects.filter(
-                        id__in=waybills_added
-                    ).select_related("src_department", "dst_department")
+                "waybills_info_list": _waybills_in_order(waybills_added),
             }
         )
     if request.method == "POST":
@@ -930,23 +978,14 @@ def edit_transport_out(request):
         form = forms.TransportOutForm(request.POST)
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             form.add_id_field(id_=transport_out_id, id_full=transport_out_id_full)
             return render(
                 request,
                 'wuliu/transport_out/edit_transport_out.html',
                 {
                     "form": form,
-                    "waybills_info_list": Waybill.objects.filter(
-                            id__in=request.session["edit_transport_out__waybills_added"]
-                        ).select_related("src_department", "dst_department")
+                    "waybills_info_list": _waybills_in_order(request.session["edit_transport_out__waybills_added"]),
                 }
             )
 
@@ -993,11 +1032,9 @@ def edit_transport_out(request):
 
 @login_required(raise_404=True)
 def edit_transport_out_js(request):
-    return render(
-        request,
-        'wuliu/_js/edit_transport_out.js.html',
-        {"logged_user_is_goods_yard": is_logged_user_is_goods_yard(request)},
-        content_type="text/javascript"
+    return _static_js_response(
+        "wuliu/_js/edit_transport_out.js.html",
+        logged_user_is_goods_yard=is_logged_user_is_goods_yard(request),
     )
 
 @login_required(raise_404=True)
@@ -1012,11 +1049,7 @@ def manage_transport_out(request):
 
 @login_required(raise_404=True)
 def manage_transport_out_js(request):
-    return render(
-        request,
-        "wuliu/_js/manage_transport_out.js.html",
-        content_type="text/javascript"
-    )
+    return _static_js_response("wuliu/_js/manage_transport_out.js.html")
 
 class SearchWaybillsToTransportOut(WaybillSearchView):
     template_name = "wuliu/transport_out/search_waybills_to_transport_out.html"
@@ -1032,10 +1065,10 @@ def add_waybills_to_transport_out(request):
         wb_add_list = []
         messages.error(request, "添加失败：无效的请求参数！")
     if request.session.get("edit_transport_out__transport_out_id"):
-        if reverse("wuliu:manage_waybill") not in request.META["HTTP_REFERER"]:
+        if _reverse_static("wuliu:manage_waybill") not in request.META.get("HTTP_REFERER", ""):
             request.session["edit_transport_out__waybills_ready_to_add"] = wb_add_list
             return redirect("%s?%s" % (
-                reverse("wuliu:edit_transport_out"),
+                _reverse_static("wuliu:edit_transport_out"),
                 urlencode({"transport_out_id": request.session.get("edit_transport_out__transport_out_id")})
             ))
     request.session["add_transport_out__waybills_ready_to_add"] = wb_add_list
@@ -1066,22 +1099,23 @@ def confirm_sign_for(request):
     except ValidationError:
         messages.error(request, "操作失败：无效的请求参数！")
         return redirect("wuliu:manage_sign_for")
-    waybill_queryset = Waybill.objects.filter(id__in=sign_for_waybill_ids)
+    # 页面中要显示每个运单的发货部门名称
+    waybill_list = list(Waybill.objects.filter(id__in=sign_for_waybill_ids).select_related("src_department"))
     # 运单到达部门必须与当前部门一致, 且必须都是"到站待提"状态
-    if waybill_queryset.filter(
-            ~Q(dst_department__id=request.session["user"]["department_id"]) |
-            ~Q(status=Waybill.Statuses.Arrived)).exists():
+    # 运单已经全部查询出来, 直接在内存中检查, 不必再单独查询一次
+    dept_id = request.session["user"]["department_id"]
+    if any(wb.dst_department_id != dept_id or wb.status != Waybill.Statuses.Arrived for wb in waybill_list):
         messages.error(request, "操作失败：请求签收的运单中存在状态异常的运单")
         return redirect("wuliu:manage_sign_for")
     return render(
         request,
         "wuliu/sign_for/confirm_sign_for.html",
-        {"waybill_list": waybill_queryset}
+        {"waybill_list": waybill_list}
     )
 
 @login_required(raise_404=True)
 def confirm_sign_for_js(request):
-    return render(request, 'wuliu/_js/confirm_sign_for.js.html', content_type="text/javascript")
+    return _static_js_response("wuliu/_js/confirm_sign_for.js.html")
 
 @login_required()
 @check_permission("manage_department_payment__add_delete")
@@ -1093,14 +1127,7 @@ def add_department_payment(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:add_department_payment")
 
         form = forms.DepartmentPaymentAddForm.init_from_request(request, data=request.POST)
@@ -1118,7 +1145,13 @@ def add_department_payment(request):
 @login_required(raise_404=True)
 @check_permission("manage_department_payment__search")
 def detail_department_payment(request, dp_id):
-    dp_obj = get_object_or_404(DepartmentPayment, pk=dp_id)
+    # department_payment_to_dict会读取两个部门外键和全部运单, 运单列表也在页面中显示, 因此预先一并查询
+    dp_obj = get_object_or_404(
+        DepartmentPayment.objects.select_related("src_department", "dst_department").prefetch_related(
+            Prefetch("waybills", queryset=Waybill.objects.select_related("src_department", "dst_department"))
+        ),
+        pk=dp_id,
+    )
     dp_dic = department_payment_to_dict(dp_obj)
     form = forms.DepartmentPaymentDetailForm(instance=dp_obj)
     return render(
@@ -1127,7 +1160,7 @@ def detail_department_payment(request, dp_id):
         {
             "form": form,
             "dp_dic": dp_dic,
-            "waybills_info_list": dp_obj.waybills.all().select_related("src_department", "dst_department"),
+            "waybills_info_list": dp_obj.waybills.all(),
         }
     )
 
@@ -1184,14 +1217,7 @@ def add_cargo_price_payment(request):
         form = forms.CargoPricePaymentForm(request.POST)
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return render(
                 request, "wuliu/finance/cargo_price_payment/add_cargo_price_payment.html",
                 {"form": form, "waybill_list": []}
@@ -1205,13 +1231,13 @@ def add_cargo_price_payment(request):
         if not form.is_valid():
             return _failed()
         # 对提交的费用运单列表再次进行检查
-        if not all([
-            waybill_ids,
-            # 不能存在除"客户签收"状态之外的运单
-            not Waybill.objects.filter(id__in=waybill_ids).exclude(status=Waybill.Statuses.SignedFor).exists(),
-            # 不能存在"已存在于其他转账单中"的运单
-            not Waybill.objects.filter(id__in=waybill_ids).filter(cargo_price_payment__isnull=False).exists(),
-        ]):
+        # 不能存在除"客户签收"状态之外的运单, 不能存在"已存在于其他转账单中"的运单
+        if not waybill_ids or any(
+            status != Waybill.Statuses.SignedFor or wb_cpp_id is not None
+            for status, wb_cpp_id in Waybill.objects.filter(id__in=waybill_ids).values_list(
+                "status", "cargo_price_payment_id"
+            )
+        ):
             custom_error_messages.append("请检查各项内容是否填写规范！")
             return _failed()
         form.instance.create_user = get_logged_user(request)
@@ -1230,7 +1256,7 @@ def add_cargo_price_payment(request):
 @login_required(raise_404=True)
 @check_permission("manage_cargo_price_payment__search")
 def detail_cargo_price_payment(request, cpp_id):
-    cpp_obj = get_object_or_404(CargoPricePayment, pk=cpp_id)
+    cpp_obj = get_object_or_404(CargoPricePayment.objects.select_related("create_user"), pk=cpp_id)
     cpp_dic = cargo_price_payment_to_dict(cpp_obj)
     form = forms.CargoPricePaymentForm(instance=cpp_obj)
     form.add_id_field(cpp_obj.id, cpp_obj.get_full_id)
@@ -1276,15 +1302,10 @@ def edit_cargo_price_payment(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
-            return redirect("%s?%s" % (reverse("wuliu:edit_cargo_price_payment"), urlencode({"cpp_id": cpp_id})))
+            _message_submit_failed(request, form, custom_error_messages)
+            return redirect("%s?%s" % (
+                _reverse_static("wuliu:edit_cargo_price_payment"), urlencode({"cpp_id": cpp_id})
+            ))
 
         try:
             waybill_ids = validate_comma_separated_integer_list_and_split(request.POST.get("waybill_ids", ""))
@@ -1306,14 +1327,13 @@ def edit_cargo_price_payment(request):
         if not _check_before_edit(cpp_obj):
             return HttpResponseForbidden()
         # 对提交的费用运单列表再次进行检查
-        if not all([
-            # 不能存在除"客户签收"状态之外的运单
-            not Waybill.objects.filter(id__in=waybill_ids).exclude(status=Waybill.Statuses.SignedFor).exists(),
-            # 不能存在"已存在于其他转账单中"的运单
-            not Waybill.objects.filter(id__in=waybill_ids).filter(
-                    Q(cargo_price_payment__isnull=False) & ~Q(cargo_price_payment_id=cpp_id)
-                ).exists(),
-        ]):
+        # 不能存在除"客户签收"状态之外的运单, 不能存在"已存在于其他转账单中"的运单
+        if any(
+            status != Waybill.Statuses.SignedFor or wb_cpp_id not in (None, cpp_obj.id)
+            for status, wb_cpp_id in Waybill.objects.filter(id__in=waybill_ids).values_list(
+                "status", "cargo_price_payment_id"
+            )
+        ):
             custom_error_messages.append("请检查各项内容是否填写规范！")
             return _failed()
         try:
@@ -1330,11 +1350,7 @@ def edit_cargo_price_payment(request):
 
 @login_required(raise_404=True)
 def edit_cargo_price_payment_js(request):
-    return render(
-        request,
-        'wuliu/_js/edit_cargo_price_payment.js.html',
-        content_type="text/javascript",
-    )
+    return _static_js_response("wuliu/_js/edit_cargo_price_payment.js.html")
 
 @login_required()
 @check_permission("manage_cargo_price_payment__search")
@@ -1421,14 +1437,7 @@ def add_customer_score_log(request):
         custom_error_messages = []
 
         def _failed():
-            messages.error(
-                request,
-                mark_safe("<br>".join([
-                    "提交失败！",
-                    *["%s: %s" % (k, "".join(v)) for k, v in form.errors.items()],
-                    *custom_error_messages,
-                ])),
-            )
+            _message_submit_failed(request, form, custom_error_messages)
             return redirect("wuliu:add_customer_score_log")
 
         if not form.is_valid():